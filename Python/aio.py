@@ -0,0 +1,147 @@
+import io
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow.parquet as pq
+from fsspec.asyn import sync, get_loop
+
+#=================================================================
+# Asyncio read engine for parquet partitions
+#=================================================================
+# Column chunks are fetched as byte ranges, many requests in flight over
+# the filesystem's pooled connections and bounded by a semaphore. Decoding
+# runs on a small thread pool, so network and CPU concurrency are set
+# independently and no worker processes are needed.
+
+
+class _RangeFile(io.RawIOBase):
+    # read-only file serving reads from prefetched byte ranges
+    def __init__(self, ranges):
+        self.ranges = sorted(ranges.items())
+        self.size = max(start + len(data) for start, data in self.ranges)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        self.pos = offset if whence == 0 else (self.pos + offset if whence == 1 else self.size + offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buffer):
+        for start, data in self.ranges:
+            if start <= self.pos < start + len(data):
+                n = min(len(buffer), start + len(data) - self.pos)
+                buffer[:n] = data[self.pos - start:self.pos - start + n]
+                self.pos += n
+                return n
+        raise IOError(f'byte {self.pos} was not prefetched')
+
+
+def column_ranges(metadata, row_groups, columns, max_gap=8 * 1024, max_size=32 * 1024 * 1024):
+    """
+    Byte ranges holding `columns` of `row_groups`, merged when closer than `max_gap`.
+
+    Like pyarrow's CacheOptions (hole_size_limit, range_size_limit): only small
+    holes are read through, so skipped columns are not downloaded, and merged
+    ranges stay below `max_size`. max_gap=0 returns the column chunks as they are.
+    """
+    names = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+    wanted = set(names) if columns is None else set(columns)
+    spans = []
+    for i in row_groups:
+        rg = metadata.row_group(i)
+        for j, name in enumerate(names):
+            if name not in wanted:
+                continue
+            chunk = rg.column(j)
+            start = chunk.data_page_offset
+            if chunk.has_dictionary_page and chunk.dictionary_page_offset:
+                start = min(start, chunk.dictionary_page_offset)
+            spans.append((start, start + chunk.total_compressed_size))
+    spans.sort()
+    merged = []
+    for start, end in spans:
+        if merged and start - merged[-1][1] <= max_gap and max(merged[-1][1], end) - merged[-1][0] <= max_size:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class AsyncReader:
+    def __init__(self, fs, net_concurrency=64, cpu_threads=4):
+        self.fs = fs
+        self.net_concurrency = net_concurrency
+        self.cpu_threads = cpu_threads
+
+    async def _cat(self, semaphore, path, start, end, stats):
+        async with semaphore:
+            if getattr(self.fs, 'async_impl', False):
+                data = await self.fs._cat_file(path, start=start, end=end)
+            else:
+                data = await asyncio.to_thread(self.fs.cat_file, path, start=start, end=end)
+        if stats is not None:
+            stats.add(requests=1, bytes_transferred=len(data))
+        return data
+
+    async def _read_file(self, semaphore, executor, path, metadata, row_groups, columns, stats, label):
+        ranges = column_ranges(metadata, row_groups, columns)
+        t = time.time()
+        data = await asyncio.gather(*[self._cat(semaphore, path, start, end, stats) for start, end in ranges])
+        if stats is not None:
+            stats.record('fetch', t, time.time(), label, file=path)
+        source = _RangeFile({start: block for (start, _), block in zip(ranges, data)})
+
+        def decode():
+            t = time.time()
+            # the ranges are in memory already, pyarrow's own read coalescing would
+            # ask for the holes between them
+            table = pq.ParquetFile(source, metadata=metadata, pre_buffer=False).read_row_groups(row_groups, columns=columns)
+            if stats is not None:
+                stats.record('decode', t, time.time(), label, file=path)
+                stats.add(bytes_decoded=table.nbytes)
+            return table
+        return await asyncio.get_running_loop().run_in_executor(executor, decode)
+
+    async def _read_all(self, tasks, columns, finish, stats, labels):
+        semaphore = asyncio.Semaphore(self.net_concurrency)
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=self.cpu_threads) as executor:
+            async def read_partition(files, label):
+                tables = await asyncio.gather(*[
+                    self._read_file(semaphore, executor, path, metadata, row_groups, columns, stats, label)
+                    for path, metadata, row_groups in files])
+
+                def assemble():
+                    t = time.time()
+                    result = finish(tables)
+                    if stats is not None:
+                        stats.record('assemble', t, time.time(), label)
+                    return result
+                return await loop.run_in_executor(executor, assemble)
+            return await asyncio.gather(*[read_partition(files, label) for files, label in zip(tasks, labels)])
+
+    def read(self, tasks, columns, finish, stats=None, labels=None):
+        """
+        Read partitions concurrently.
+
+        tasks: one list of (path, metadata, row_groups) per partition.
+        finish: called on a decode thread with the partition's Arrow tables,
+        its return value is collected in task order.
+        stats: optional QueryStats recording requests, bytes and the fetch,
+        decode and assemble time of each partition, named by `labels`.
+        """
+        if labels is None:
+            labels = list(range(len(tasks)))
+        # run on the filesystem's own loop to reuse its connection pool, or on
+        # fsspec's IO thread, which also works inside a running notebook loop
+        loop = getattr(self.fs, 'loop', None) if getattr(self.fs, 'async_impl', False) else None
+        return sync(loop or get_loop(), self._read_all, tasks, columns, finish, stats, labels)
@@ -0,0 +1,265 @@
+"""
+Offline benchmark suite for GlobalEarthPoint.
+
+Builds a synthetic partitioned GEDI dataset, serves it through local S3 and
+HTTP stand-ins, and times scan, retrieve, bbox_query, download_gedi and
+tile_query across AOI sizes, time ranges and worker counts, plus the cold
+import of the modules. Every case runs in a fresh process so peak RSS is
+per case. Results are written to
+benchmarks/results/<label>.json and can be compared with an earlier run:
+
+    python benchmarks/bench.py --label after --compare benchmarks/results/before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing as mp
+from queue import Empty
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+AOIS = {'small': 0.25, 'medium': 1.0, 'large': 2.5}
+TIME_RANGES = {'month': ('2020-03-01', '2020-03-31'),
+               'year': ('2020-01-01', '2020-12-31'),
+               'all': ('2019-04-18', '2023-03-16')}
+ENGINES = [('async', 8), ('async', 64), ('joblib', 1), ('joblib', 4)]
+# the query core should load none of these, see the 'import' case
+HEAVY_MODULES = ('geopandas', 'leafmap', 'folium', 'contextily', 'matplotlib', 'IPython',
+                 's3fs', 'aiobotocore', 'requests', 'joblib')
+
+
+def _aoi(extent, size):
+    from shapely.geometry import box
+    xmin, ymin, xmax, ymax = extent
+    cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+    return box(cx - size / 2, cy - size / 2, cx + size / 2, cy + size / 2)
+
+
+def _func_reader(root, args, geom, time_range, engine, workers):
+    import func
+    from standins import S3StandIn
+    start_dt, end_dt = TIME_RANGES[time_range]
+    fs = S3StandIn(latency=args.latency)
+    reader = func.gedil2(geom, start_dt=start_dt, end_dt=end_dt, engine=engine,
+                         n_jobs=workers, net_concurrency=workers,
+                         dataset=os.path.join(root, 'partitioned'), fs=fs,
+                         lookup_file=os.path.join(root, 'lookup.fgb'))
+    return reader, fs.counters
+
+
+def case_scan(root, args, spec, aoi, time_range):
+    reader, counters = _func_reader(root, args, _aoi(spec['extent'], AOIS[aoi]), time_range, 'async', 64)
+    result = reader.scan()
+    return {'rows': result['row counts'], 'bytes': counters.bytes, 'requests': counters.requests}
+
+
+def case_retrieve(root, args, spec, aoi, time_range, engine, workers):
+    reader, counters = _func_reader(root, args, _aoi(spec['extent'], AOIS[aoi]), time_range, engine, workers)
+    result = reader.retrieve(output='arrow')
+    return {'rows': 0 if result is None else result.num_rows,
+            'bytes': counters.bytes, 'requests': counters.requests}
+
+
+def case_tile_query(root, args, spec, queries):
+    import numpy as np
+    from shapely.geometry import box
+    from globalearthpoint import gedil2
+    xmin, ymin, xmax, ymax = spec['extent']
+    rng = np.random.default_rng(0)
+    xs, ys = rng.uniform(xmin, xmax, queries), rng.uniform(ymin, ymax, queries)
+    for x, y in zip(xs, ys):
+        gedil2(box(x, y, x + 0.1, y + 0.1), years=spec['years'],
+               lookup_file=os.path.join(root, 'lookup.fgb')).tile_query()
+    return {'rows': queries, 'bytes': 0, 'requests': 0}
+
+
+def case_bbox_query(root, args, spec, aoi):
+    import polars as pl
+    from globalearthpoint import gedil2
+    from standins import HTTPStandIn
+    with HTTPStandIn(root, latency=args.latency) as server:
+        obj = gedil2(_aoi(spec['extent'], AOIS[aoi]), years=spec['years'],
+                     lookup_file=os.path.join(root, 'lookup.fgb'), url_dataset=server.url + '/tiles')
+        frames = pl.collect_all(list(obj.bbox_query(columns='reduced').values()))
+        return {'rows': sum(f.height for f in frames),
+                'bytes': server.counters.bytes, 'requests': server.counters.requests}
+
+
+def case_download_gedi(root, args, spec, cores, rerun):
+    from globalearthpoint import gedil2
+    from standins import HTTPStandIn
+    out_dir = tempfile.mkdtemp(prefix='gep-bench-download-')
+    try:
+        with HTTPStandIn(root, latency=args.latency) as server:
+            obj = gedil2(_aoi(spec['extent'], AOIS['large']), years=spec['years'],
+                         lookup_file=os.path.join(root, 'lookup.fgb'), url_dataset=server.url + '/tiles')
+            tiles = obj.tile_query()
+            if rerun:
+                obj.download_gedi(tiles, out_dir=out_dir, cores=cores, progress=False, require_confirmation=False)
+                server.counters.reset()
+            t = time.perf_counter()
+            obj.download_gedi(tiles, out_dir=out_dir, cores=cores, progress=False, require_confirmation=False)
+            return {'rows': int(tiles['n_points'].sum()), 'bytes': server.counters.bytes,
+                    'requests': server.counters.requests, 'seconds': time.perf_counter() - t}
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def case_import(root, args, spec, module):
+    # a new interpreter, the case process itself has everything imported already
+    code = (f'import sys, time, json, resource\n'
+            f't = time.perf_counter()\n'
+            f'import {module}\n'
+            f'seconds = time.perf_counter() - t\n'
+            f'print(json.dumps({{"seconds": seconds, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, '
+            f'"heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))')
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(HERE), capture_output=True, text=True, check=True)
+    return dict(json.loads(out.stdout.splitlines()[-1]), rows=0, bytes=0, requests=0)
+
+
+CASES = {
+    'import': case_import,
+    'scan': case_scan,
+    'retrieve': case_retrieve,
+    'tile_query': case_tile_query,
+    'bbox_query': case_bbox_query,
+    'download_gedi': case_download_gedi,
+}
+
+
+def plan(selected):
+    cases = [('import', {'module': module}) for module in ('globalearthpoint', 'func', 'viz')]
+    for aoi in AOIS:
+        for time_range in TIME_RANGES:
+            cases.append(('scan', {'aoi': aoi, 'time_range': time_range}))
+            for engine, workers in ENGINES:
+                cases.append(('retrieve', {'aoi': aoi, 'time_range': time_range,
+                                           'engine': engine, 'workers': workers}))
+        cases.append(('bbox_query', {'aoi': aoi}))
+    cases.append(('tile_query', {'queries': 1000}))
+    for cores in (1, 8):
+        for rerun in (False, True):
+            cases.append(('download_gedi', {'cores': cores, 'rerun': rerun}))
+    return [c for c in cases if not selected or c[0] in selected]
+
+
+def _run_case(queue, name, params, root, args, spec, cache_dir):
+    # child process: cold caches, quiet library output, own peak RSS
+    os.environ['GEP_CACHE_DIR'] = cache_dir
+    os.chdir(os.path.dirname(HERE))
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # import time is not part of the case
+            import func, globalearthpoint  # noqa: F401
+            t = time.perf_counter()
+            result = CASES[name](root, args, spec, **params)
+            result.setdefault('seconds', time.perf_counter() - t)
+        result.setdefault('peak_rss_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+        queue.put(result)
+    except Exception as e:
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+    # exit without joining joblib's idle worker pool, which lingers for minutes
+    queue.close()
+    queue.join_thread()
+    os._exit(0)
+
+
+def run_case(name, params, root, args, spec):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    cache_dir = tempfile.mkdtemp(prefix='gep-bench-cache-')
+    try:
+        proc = ctx.Process(target=_run_case, args=(queue, name, params, root, args, spec, cache_dir))
+        proc.start()
+        while True:
+            try:
+                result = queue.get(timeout=1)
+                break
+            except Empty:
+                if not proc.is_alive():
+                    result = {'error': f'case process exited with code {proc.exitcode}'}
+                    break
+        proc.join()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if 'error' not in result:
+        seconds = result['seconds']
+        result['points_per_s'] = result['rows'] / seconds if seconds else None
+        result['mb'] = result['bytes'] / 1e6
+        result['mb_per_s'] = result['mb'] / seconds if seconds else None
+    return {'case': name, 'params': params, **result}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(result):
+    return result['case'] + json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {_key(r): r for r in json.load(f)['results']}
+    print(f"\n{'case':<60} {'before s':>10} {'after s':>10} {'ratio':>7}")
+    for r in results:
+        old = baseline.get(_key(r))
+        if old is None or 'error' in old or 'error' in r:
+            continue
+        ratio = r['seconds'] / old['seconds'] if old['seconds'] else float('nan')
+        flag = '  <-- slower' if ratio > 1.2 else ''
+        print(f"{_key(r)[:60]:<60} {old['seconds']:>10.3f} {r['seconds']:>10.3f} {ratio:>7.2f}{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--root', default=os.path.join(tempfile.gettempdir(), 'gep-bench-data'),
+                        help='directory of the synthetic dataset (reused if the spec matches)')
+    parser.add_argument('--points', type=int, default=2000, help='points per tile and month')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added to every request')
+    parser.add_argument('--cases', nargs='*', choices=sorted(CASES), help='run only these cases')
+    parser.add_argument('--label', default=time.strftime('%Y%m%d-%H%M%S'))
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    import synthetic
+    spec = synthetic.ensure(args.root, points=args.points)
+
+    results = []
+    for name, params in plan(args.cases):
+        result = run_case(name, params, args.root, args, spec)
+        results.append(result)
+        if 'error' in result:
+            print(f"{name:<14} {json.dumps(params):<70} ERROR {result['error']}")
+        else:
+            print(f"{name:<14} {json.dumps(params):<70} {result['seconds']:8.3f} s "
+                  f"{result['points_per_s'] or 0:12.0f} pts/s {result['mb_per_s'] or 0:8.1f} MB/s "
+                  f"{result['peak_rss_mb']:8.0f} MB RSS" +
+                  (f"  loads {', '.join(result['heavy'])}" if result.get('heavy') else ''))
+
+    os.makedirs(os.path.join(HERE, 'results'), exist_ok=True)
+    out = os.path.join(HERE, 'results', f'{args.label}.json')
+    with open(out, 'w') as f:
+        json.dump({'label': args.label, 'commit': _git_commit(), 'python': platform.python_version(),
+                   'platform': platform.platform(), 'cpus': os.cpu_count(), 'latency': args.latency,
+                   'spec': spec, 'results': results}, f, indent=1)
+    print(f'\nresults written to {out}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
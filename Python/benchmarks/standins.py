@@ -0,0 +1,187 @@
+import io
+import os
+import re
+import time
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from fsspec.implementations.local import LocalFileSystem
+
+#=================================================================
+# Local stand-ins for the Wasabi bucket
+#=================================================================
+# Both count requests and bytes and can add a fixed latency per request,
+# so runs are reproducible without network access.
+
+
+class Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes = 0
+
+    def __getstate__(self):
+        # worker processes count into their own copy
+        return {'requests': self.requests, 'bytes': self.bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, requests=0, nbytes=0):
+        with self._lock:
+            self.requests += requests
+            self.bytes += nbytes
+
+
+class _CountingFile(io.RawIOBase):
+    def __init__(self, f, fs):
+        self.f = f
+        self.fs = fs
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def readinto(self, buffer):
+        self.fs._request()
+        n = self.f.readinto(buffer)
+        self.fs.counters.add(nbytes=n)
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class S3StandIn(LocalFileSystem):
+    """Local filesystem behaving like a slow object store: every read and listing is a request."""
+
+    cachable = False
+
+    def __init__(self, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.counters = Counters()
+
+    def _request(self):
+        self.counters.add(requests=1)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _open(self, path, mode='rb', **kwargs):
+        f = super()._open(path, mode=mode, **kwargs)
+        if 'r' not in mode:
+            return f
+        return _CountingFile(f, self)
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        self._request()
+        data = super().cat_file(path, start=start, end=end, **kwargs)
+        self.counters.add(nbytes=len(data))
+        return data
+
+    def find(self, path, *args, **kwargs):
+        # one listing request, as a paginated S3 LIST of a small prefix would be
+        self._request()
+        return super().find(path, *args, **kwargs)
+
+
+class _RangeHandler(SimpleHTTPRequestHandler):
+    # static files with HEAD, ETag and single Range requests, like S3 over HTTPS
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, path, start=None, end=None):
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+        if start is None:
+            self.send_response(200)
+            self.send_header('Content-Length', str(size))
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return size, etag
+
+    def _serve(self, body):
+        server = self.server
+        server.counters.add(requests=1)
+        if server.latency:
+            time.sleep(server.latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start = end = None
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            first, last = match.groups()
+            if first:
+                start, end = int(first), int(last) if last else size - 1
+            else:
+                start, end = size - int(last), size - 1
+            start, end = max(start, 0), min(end, size - 1)
+            if_range = self.headers.get('If-Range')
+            if if_range and if_range != f'"{os.stat(path).st_mtime_ns:x}-{size:x}"':
+                start = end = None
+        self._headers(path, start, end)
+        if not body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start or 0)
+            remaining = size if start is None else end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                server.counters.add(nbytes=len(chunk))
+                remaining -= len(chunk)
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+
+class HTTPStandIn:
+    """Threaded HTTP server for `directory` on an ephemeral localhost port."""
+
+    def __init__(self, directory, latency=0.0):
+        handler = lambda *args, **kwargs: _RangeHandler(*args, directory=directory, **kwargs)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.counters = Counters()
+        self.counters = self.server.counters
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
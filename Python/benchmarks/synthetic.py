@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import geopandas as gpd
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from func import GEDI_COLUMNS, _tile_name
+
+#=================================================================
+# Synthetic GEDI L2 dataset with the layout of the real bucket
+#=================================================================
+# partitioned/  tile=XXXE_YYN/year=YYYY/month=M/part-0.parquet   (func.gedil2)
+# tiles/        lon=X/lat=Y/year=YYYY/gedi_l2_0.parquet          (globalearthpoint.gedil2)
+# lookup.fgb    one row per 5x5 degree tile and year of tiles/
+
+# bump when the layout written by build() changes
+VERSION = 2
+
+ARROW_TYPES = {'Int64': pa.int64(), 'Int32': pa.int32(), 'Int16': pa.int16(), 'Uint8': pa.uint8(),
+               'Uint64': pa.uint64(), 'Float64': pa.float64(), 'Boolean': pa.bool_()}
+
+
+def gedi_schema(path=GEDI_COLUMNS):
+    columns = pd.read_csv(path)
+    return pa.schema([(row.Variable.strip(), ARROW_TYPES[row.Data_type.strip()])
+                      for row in columns.itertuples() if row.Variable not in ('lon', 'lat', 'year')])
+
+
+def _random_column(rng, field, n, lon, lat, t0, t1):
+    if field.name == 'longitude':
+        return lon + rng.random(n)
+    if field.name == 'latitude':
+        return lat + rng.random(n)
+    if field.name == 'delta_time':
+        return np.sort(rng.integers(t0, t1, n))
+    if pa.types.is_boolean(field.type):
+        return rng.random(n) > 0.5
+    if pa.types.is_floating(field.type):
+        return rng.random(n)
+    if field.type == pa.uint64():
+        return rng.integers(0, 2**62, n, dtype=np.uint64)
+    info = np.iinfo(field.type.to_pandas_dtype())
+    return rng.integers(0, min(info.max, 10000), n)
+
+
+def make_partition(rng, schema, n, lon, lat, year, month):
+    start = pd.Timestamp(year=year, month=month, day=1)
+    t0, t1 = int(start.timestamp()), int((start + pd.offsets.MonthBegin()).timestamp())
+    table = pa.table({f.name: pa.array(_random_column(rng, f, n, lon, lat, t0, t1)).cast(f.type)
+                      for f in schema}, schema=schema)
+    # sort by latitude so row-group statistics are selective, as in the real data
+    return table.sort_by('latitude')
+
+
+def build(root, extent=(99, 19, 103, 21), years=(2020, 2021), points=2000, row_group_size=1000, seed=0):
+    """
+    Write the synthetic dataset for the 1x1 degree tiles in `extent`
+    (xmin, ymin, xmax, ymax) with `points` shots per tile and month.
+    """
+    rng = np.random.default_rng(seed)
+    schema = gedi_schema()
+    xmin, ymin, xmax, ymax = extent
+    per_tile5 = {}
+    for lon in range(xmin, xmax):
+        for lat in range(ymin, ymax):
+            for year in years:
+                for month in range(1, 13):
+                    table = make_partition(rng, schema, points, lon, lat, year, month)
+                    path = os.path.join(root, 'partitioned', f'tile={_tile_name(lon, lat)}', f'year={year}', f'month={month}')
+                    os.makedirs(path, exist_ok=True)
+                    pq.write_table(table, os.path.join(path, 'part-0.parquet'), row_group_size=row_group_size)
+                    key = (lon // 5 * 5, lat // 5 * 5, year)
+                    per_tile5.setdefault(key, []).append(table)
+
+    rows = []
+    for (lon, lat, year), tables in sorted(per_tile5.items()):
+        dir = f'/lon={lon}/lat={lat}/year={year}/gedi_l2_0.parquet'
+        path = os.path.join(root, 'tiles', dir.lstrip('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pa.concat_tables(tables).sort_by('latitude')
+        # the 5x5 degree files also carry their partition keys as columns
+        for name, value in (('lon', lon), ('lat', lat), ('year', year)):
+            table = table.append_column(name, pa.array([value] * table.num_rows, pa.int16()))
+        pq.write_table(table, path, row_group_size=row_group_size * 10)
+        rows.append({'lon': float(lon), 'lat': float(lat), 'year': float(year), 'dir': dir,
+                     'n_points': table.num_rows, 'geometry': box(lon, lat, lon + 5, lat + 5)})
+    lookup = gpd.GeoDataFrame(rows, crs=4326)
+    lookup['n_points'] = lookup['n_points'].astype('int32')
+    lookup.to_file(os.path.join(root, 'lookup.fgb'), driver='FlatGeobuf')
+
+    spec = {'extent': list(extent), 'years': list(years), 'points': points,
+            'row_group_size': row_group_size, 'seed': seed, 'version': VERSION}
+    with open(os.path.join(root, 'spec.json'), 'w') as f:
+        json.dump(spec, f)
+    return spec
+
+
+def ensure(root, **kwargs):
+    # rebuild only when the requested spec differs from what is on disk
+    spec_file = os.path.join(root, 'spec.json')
+    if os.path.exists(spec_file):
+        with open(spec_file) as f:
+            spec = json.load(f)
+        wanted = dict(spec, **{k: list(v) if isinstance(v, tuple) else v for k, v in kwargs.items()})
+        if wanted == spec and spec.get('version') == VERSION:
+            return spec
+    for name in ('partitioned', 'tiles'):
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return build(root, **kwargs)
@@ -0,0 +1,164 @@
+import os
+import time
+import uuid
+import hashlib
+import sqlite3
+import contextlib
+
+
+def default_cache_dir():
+    return os.environ.get('GEP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'globalearthpoint'))
+
+
+class PartitionCache:
+    #=================================================================
+    # Size-bounded on-disk LRU cache of remote partition files
+    #=================================================================
+    # Files are keyed by dataset version and path. The index lives in a
+    # sqlite database so several processes can share one cache directory;
+    # files are written to unique temporary names and renamed into place.
+    # Readers hold a lease on the files they use, leased files are never
+    # evicted; leases of a crashed process expire after lease_ttl seconds.
+
+    def __init__(self, cache_dir=None, max_bytes=50 * 1024**3, lease_ttl=3600):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lease_ttl = lease_ttl
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS entries '
+                        '(key TEXT PRIMARY KEY, version TEXT, path TEXT, size INTEGER, last_access REAL)')
+            con.execute('CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)')
+            con.execute('CREATE TABLE IF NOT EXISTS leases '
+                        '(key TEXT, owner TEXT, expires REAL, PRIMARY KEY (key, owner))')
+            # hit/miss counters are shared by every process using the cache
+            con.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        con = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), timeout=60)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    @staticmethod
+    def _count(con, name, n=1):
+        con.execute('INSERT INTO counters VALUES (?, ?) '
+                    'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, n))
+
+    @staticmethod
+    def key(version, path):
+        return hashlib.sha256(f'{version}|{path}'.encode()).hexdigest()
+
+    def _local_path(self, key, path):
+        ext = os.path.splitext(path)[1]
+        return os.path.join(self.cache_dir, 'objects', key[:2], key + ext)
+
+    def _hold(self, con, key, lease):
+        # add `key` to the lease and extend all files of the lease
+        if lease is None:
+            return
+        expires = time.time() + self.lease_ttl
+        con.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)', (key, lease, expires))
+        con.execute('UPDATE leases SET expires = ? WHERE owner = ?', (expires, lease))
+
+    @contextlib.contextmanager
+    def lease(self):
+        """Lease id for get(); the files fetched under it stay cached until the block exits."""
+        lease = uuid.uuid4().hex
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def release(self, lease):
+        with self._connect() as con:
+            con.execute('DELETE FROM leases WHERE owner = ?', (lease,))
+        # files kept past the budget by this lease can go now
+        self.evict()
+
+    def get(self, version, path, fetch, lease=None):
+        """
+        Local path of `path` from dataset `version`, downloading it on a miss.
+
+        `fetch(local_path)` must write the remote file to `local_path`.
+        With a `lease` (see lease()) the file is protected from eviction,
+        also by other processes, until the lease is released.
+        """
+        key = self.key(version, path)
+        local_path = self._local_path(key, path)
+        with self._connect() as con:
+            row = con.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and os.path.exists(local_path):
+                con.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+                self._hold(con, key, lease)
+                self._count(con, 'hits')
+                return local_path
+            self._count(con, 'misses')
+
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp = f'{local_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            fetch(tmp)
+            os.replace(tmp, local_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                        (key, version, path, os.path.getsize(local_path), time.time()))
+            self._hold(con, key, lease)
+        self.evict(keep=key)
+        return local_path
+
+    def evict(self, keep=None):
+        # drop least recently used files until the cache fits its byte budget,
+        # leased files stay even if the cache is over budget until they are released
+        with self._connect() as con:
+            con.execute('DELETE FROM leases WHERE expires <= ?', (time.time(),))
+            total = con.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, path, size in con.execute('SELECT key, path, size FROM entries '
+                                               'WHERE key NOT IN (SELECT key FROM leases) '
+                                               'ORDER BY last_access').fetchall():
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                con.execute('DELETE FROM entries WHERE key = ?', (key,))
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._local_path(key, path))
+                total -= size
+                self._count(con, 'evictions')
+
+    def clear(self):
+        with self._connect() as con:
+            for key, path in con.execute('SELECT key, path FROM entries').fetchall():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._local_path(key, path))
+            con.execute('DELETE FROM entries')
+            con.execute('DELETE FROM leases')
+
+    def stats(self):
+        with self._connect() as con:
+            n, size = con.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+            counters = dict(con.execute('SELECT name, value FROM counters').fetchall())
+        return {'hits': counters.get('hits', 0), 'misses': counters.get('misses', 0),
+                'evictions': counters.get('evictions', 0),
+                'entries': n, 'bytes': size, 'max_bytes': self.max_bytes}
+
+
+def resolve_cache(cache):
+    # cache=None disables caching, True uses the default location
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return PartitionCache()
+    if isinstance(cache, (str, os.PathLike)):
+        return PartitionCache(cache)
+    return cache
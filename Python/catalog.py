@@ -0,0 +1,95 @@
+import os
+import threading
+
+import numpy as np
+from shapely import STRtree
+
+
+class LookupCatalog:
+    #=================================================================
+    # In-memory spatial index over the tile-year rows of lookup.fgb
+    #=================================================================
+
+    def __init__(self, lookup_file='lookup.fgb'):
+        self.lookup_file = os.path.abspath(lookup_file)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.table = None
+        self.tree = None
+        self.years = None
+        self.year_index = {}
+        self.refresh()
+
+    def _load(self, mtime):
+        # geopandas is imported with the first lookup, not with the module
+        import geopandas as gpd
+        table = gpd.read_file(self.lookup_file)
+        table['year'] = table['year'].astype(int)
+        table = table.reset_index(drop=True)
+        years = table['year'].to_numpy()
+
+        self.table = table
+        self.tree = STRtree(table.geometry.values)
+        self.years = years
+        self.year_index = {int(y): np.flatnonzero(years == y) for y in np.unique(years)}
+        self._mtime = mtime
+
+    def refresh(self):
+        # reload only if the file changed on disk since the last load
+        mtime = os.stat(self.lookup_file).st_mtime_ns
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._load(mtime)
+        return self
+
+    def _year_mask(self, rows, years):
+        if years is None:
+            return np.ones(len(rows), dtype=bool)
+        return np.isin(self.years[rows], np.asarray(list(years), dtype=int))
+
+    def query(self, geometry, years=None):
+        """Tile-year rows intersecting a single geometry, optionally limited to `years`."""
+        self.refresh()
+        rows = self.tree.query(geometry, predicate='intersects')
+        rows = np.sort(rows[self._year_mask(rows, years)])
+        return self.table.iloc[rows]
+
+    def query_many(self, geometries, years=None):
+        """
+        Tile-year rows intersecting any of `geometries` in one vectorized call.
+
+        Returns one row per (geometry, tile-year) pair with the position of the
+        input geometry in the `query_index` column.
+        """
+        self.refresh()
+        geoms = np.asarray(getattr(geometries, 'values', geometries), dtype=object)
+        query_idx, rows = self.tree.query(geoms, predicate='intersects')
+        keep = self._year_mask(rows, years)
+        query_idx, rows = query_idx[keep], rows[keep]
+        order = np.lexsort((rows, query_idx))
+        hits = self.table.iloc[rows[order]].copy()
+        hits.insert(0, 'query_index', query_idx[order])
+        return hits
+
+    def tiles_for_years(self, years=None):
+        self.refresh()
+        if years is None:
+            return self.table
+        rows = [self.year_index[int(y)] for y in years if int(y) in self.year_index]
+        rows = np.sort(np.concatenate(rows)) if rows else np.array([], dtype=int)
+        return self.table.iloc[rows]
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(lookup_file='lookup.fgb'):
+    # process-wide catalog, one per lookup file
+    key = os.path.abspath(lookup_file)
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = _catalogs[key] = LookupCatalog(key)
+    return catalog.refresh()
@@ -0,0 +1,21 @@
+import os
+
+import pandas as pd
+
+#=================================================================
+# Column encoding of the GEDI parquet datasets
+#=================================================================
+# Most metrics are stored as scaled integers, value = stored * Scale,
+# as listed in gedi_columns.csv next to this module.
+
+GEDI_COLUMNS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gedi_columns.csv')
+
+
+def load_scale_factors(path=GEDI_COLUMNS):
+    # scale factors of the integer-encoded columns, from the Scale column of gedi_columns.csv
+    columns = pd.read_csv(path)
+    columns = columns[columns['Scale'].astype(float) != 1]
+    return dict(zip(columns['Variable'].str.strip(), columns['Scale'].astype(float)))
+
+
+SCALE_FACTORS = load_scale_factors()
@@ -0,0 +1,164 @@
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class IncompleteDownload(IOError):
+    # the transfer ended before the expected size, worth another (resumed) attempt
+    pass
+
+
+class TileDownloader:
+    #=================================================================
+    # Pooled, resumable and retrying downloader for parquet tiles
+    #=================================================================
+
+    def __init__(self, chunk_size=8 * 1024 * 1024, retries=5, backoff=1.0,
+                 pool_size=32, timeout=60):
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # one session with keep-alive connections shared by all downloads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def _sidecar(filepath, suffix):
+        dirname, basename = os.path.split(filepath)
+        return os.path.join(dirname, f'.{basename}.{suffix}')
+
+    @staticmethod
+    def _read_text(path):
+        try:
+            with open(path) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_text(path, text):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def head_info(self, url, stats=None):
+        # size, ETag and Last-Modified of the remote object
+        if stats is not None:
+            stats.add(requests=1)
+        response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+        size = response.headers.get('Content-Length')
+        return {'size': int(size) if size is not None else None, 'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+
+    def head(self, url, stats=None):
+        info = self.head_info(url, stats)
+        return info['size'], info['etag']
+
+    def _is_current(self, filepath, size, etag):
+        if not os.path.exists(filepath):
+            return False
+        # a truncated or overwritten copy is stale whatever its ETag sidecar says
+        if size is not None and os.path.getsize(filepath) != size:
+            return False
+        if etag is not None:
+            local_etag = self._read_text(self._sidecar(filepath, 'etag'))
+            if local_etag is not None:
+                return local_etag == etag
+        return size is not None and os.path.getsize(filepath) == size
+
+    def _fetch(self, url, part, size, etag, stats=None):
+        # resume a partial download of the same remote object with a Range request
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        part_etag = self._read_text(self._sidecar(part, 'etag'))
+        if offset and (etag != part_etag or (size is not None and offset > size)):
+            offset = 0
+        if size is not None and offset == size:
+            return
+
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if etag is not None:
+                headers['If-Range'] = etag
+        if etag is not None:
+            self._write_text(self._sidecar(part, 'etag'), etag)
+
+        if stats is not None:
+            stats.add(requests=1)
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            # server ignored the range or the object changed: start over
+            mode = 'ab' if offset and response.status_code == 206 else 'wb'
+            with open(part, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    if stats is not None:
+                        stats.add(bytes_transferred=len(chunk))
+
+        if size is not None and os.path.getsize(part) != size:
+            raise IncompleteDownload(f'Incomplete download of {url}: {os.path.getsize(part)} of {size} bytes')
+
+    def download(self, url, filepath, stats=None, remote=None):
+        """
+        Download `url` to `filepath` unless an identical copy already exists.
+
+        Data is written to a hidden `.part` file that is renamed into place
+        once complete, so an interrupted run never leaves a truncated tile.
+        Returns the filepath and whether the tile was actually transferred.
+        Requests and bytes are counted in `stats` (a QueryStats) if given.
+        `remote` is a head_info() result to use instead of a first HEAD request.
+        """
+        part = self._sidecar(filepath, 'part')
+        pending = [remote]
+
+        def attempt():
+            # only the first attempt may use the caller's HEAD, retries ask again
+            info = (pending.pop() if pending else None) or self.head_info(url, stats)
+            size, etag = info['size'], info['etag']
+            if self._is_current(filepath, size, etag):
+                return filepath, False
+            self._fetch(url, part, size, etag, stats)
+            os.replace(part, filepath)
+            etag_file = self._sidecar(filepath, 'etag')
+            if etag is not None:
+                os.replace(self._sidecar(part, 'etag'), etag_file)
+            elif os.path.exists(etag_file):
+                os.remove(etag_file)
+            return filepath, True
+
+        return self._retry(attempt)
+
+    def fetch(self, url, filepath, stats=None):
+        # plain retried download for callers that manage file naming themselves
+        def attempt():
+            if stats is not None:
+                stats.add(requests=1)
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                with open(filepath, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        if stats is not None:
+                            stats.add(bytes_transferred=len(chunk))
+            return filepath
+
+        return self._retry(attempt)
+
+    def _retry(self, fn):
+        # only network errors and short transfers are retried, local
+        # errors (disk full, permissions, missing directory) surface at once
+        for attempt in range(self.retries + 1):
+            try:
+                return fn()
+            except (requests.RequestException, IncompleteDownload) as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if attempt == self.retries or (status is not None and status < 500 and status not in (408, 429)):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
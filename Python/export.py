@@ -0,0 +1,227 @@
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+#=================================================================
+# Spatially sorted GeoParquet / FlatGeobuf export
+#=================================================================
+# Query output is streamed into sorted runs along a Hilbert curve, spilled
+# to Arrow IPC files when it does not fit in `run_rows`, and merged back in
+# curve order. Consecutive rows are then close in space, so each written
+# row group covers a small box and bbox reads of the export prune most of
+# them on the statistics of the bbox covering column.
+
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+
+KEY = '_hilbert'
+
+
+def hilbert_index(lon, lat, bbox=WORLD, order=24):
+    """Position of each point along a Hilbert curve of 2**order x 2**order cells over `bbox`."""
+    n = 1 << order
+    xmin, ymin, xmax, ymax = bbox
+    x = np.clip((np.asarray(lon, dtype=float) - xmin) / (xmax - xmin) * n, 0, n - 1).astype(np.uint64)
+    y = np.clip((np.asarray(lat, dtype=float) - ymin) / (ymax - ymin) * n, 0, n - 1).astype(np.uint64)
+    d = np.zeros(len(x), dtype=np.uint64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & np.uint64(s)) > 0
+        ry = (y & np.uint64(s)) > 0
+        d += np.uint64(s) * np.uint64(s) * ((3 * rx.astype(np.uint64)) ^ ry.astype(np.uint64))
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x[flip] = np.uint64(n - 1) - x[flip]
+        y[flip] = np.uint64(n - 1) - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        s >>= 1
+    return d
+
+
+def _to_table(batch):
+    # polars DataFrames, Arrow tables and record batches
+    if hasattr(batch, 'to_arrow'):
+        batch = batch.to_arrow()
+    return pa.table(batch) if isinstance(batch, pa.RecordBatch) else batch
+
+
+def _sorted_runs(batches, bbox, order, run_rows, tmp_dir):
+    # sort the input in runs of at most run_rows rows, spilling all but a single run to disk
+    runs, pending, rows = [], [], 0
+    extent = [np.inf, np.inf, -np.inf, -np.inf]
+
+    def flush():
+        table = pa.concat_tables(pending).sort_by(KEY)
+        pending.clear()
+        path = os.path.join(tmp_dir, f'run-{len(runs)}.arrow')
+        with pa.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table, max_chunksize=65536)
+        runs.append(path)
+
+    for batch in batches:
+        table = _to_table(batch)
+        if table.num_rows == 0:
+            continue
+        lon, lat = table['longitude'].to_numpy(), table['latitude'].to_numpy()
+        extent = [min(extent[0], lon.min()), min(extent[1], lat.min()),
+                  max(extent[2], lon.max()), max(extent[3], lat.max())]
+        pending.append(table.append_column(KEY, pa.array(hilbert_index(lon, lat, bbox, order))))
+        rows += table.num_rows
+        if rows >= run_rows:
+            flush()
+            rows = 0
+    if pending and runs:
+        flush()
+    if not runs:
+        # everything fit in memory, no spill
+        return [pa.concat_tables(pending).sort_by(KEY)] if pending else [], extent
+    return runs, extent
+
+
+def _merge_runs(runs):
+    # k-way merge of sorted runs holding one record batch per run in memory
+    if len(runs) == 1 and isinstance(runs[0], pa.Table):
+        yield runs[0]
+        return
+    readers = [pa.ipc.open_file(path) for path in runs]
+    positions = [0] * len(readers)
+    buffers = [None] * len(readers)
+
+    def refill(i):
+        while (buffers[i] is None or buffers[i].num_rows == 0) and positions[i] < readers[i].num_record_batches:
+            buffers[i] = pa.table(readers[i].get_batch(positions[i]))
+            positions[i] += 1
+
+    for i in range(len(readers)):
+        refill(i)
+    while any(b is not None and b.num_rows for b in buffers):
+        # rows up to the smallest last key of the runs with more data left are final
+        open_runs = [b[KEY][-1].as_py() for i, b in enumerate(buffers)
+                     if b is not None and b.num_rows and positions[i] < readers[i].num_record_batches]
+        bound = min(open_runs) if open_runs else None
+        taken = []
+        for i, b in enumerate(buffers):
+            if b is None or b.num_rows == 0:
+                continue
+            n = b.num_rows if bound is None else int(np.searchsorted(b[KEY].to_numpy(), bound, side='right'))
+            taken.append(b.slice(0, n))
+            buffers[i] = b.slice(n)
+            refill(i)
+        yield pa.concat_tables(taken).sort_by(KEY)
+
+
+def _rechunk(tables, rows):
+    # tables of exactly `rows` rows (the last one shorter), one per row group
+    pending, count = [], 0
+    for table in tables:
+        pending.append(table)
+        count += table.num_rows
+        while count >= rows:
+            merged = pa.concat_tables(pending)
+            yield merged.slice(0, rows)
+            pending, count = [merged.slice(rows)], count - rows
+    if count:
+        yield pa.concat_tables(pending)
+
+
+def _with_geometry(table, covering):
+    lon, lat = table['longitude'], table['latitude']
+    geometry = shapely.to_wkb(shapely.points(lon.to_numpy(), lat.to_numpy()))
+    table = table.drop_columns([KEY]).append_column('geometry', pa.array(geometry, pa.binary()))
+    if covering:
+        bbox = pa.StructArray.from_arrays([lon.combine_chunks(), lat.combine_chunks(), lon.combine_chunks(),
+                                           lat.combine_chunks()], names=['xmin', 'ymin', 'xmax', 'ymax'])
+        table = table.append_column('bbox', bbox)
+    return table
+
+
+def _geo_metadata(extent):
+    return {'version': '1.1.0', 'primary_column': 'geometry',
+            'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point'],
+                                     'bbox': [float(v) for v in extent],
+                                     'covering': {'bbox': {'xmin': ['bbox', 'xmin'], 'ymin': ['bbox', 'ymin'],
+                                                           'xmax': ['bbox', 'xmax'], 'ymax': ['bbox', 'ymax']}}}}}
+
+
+def _write_geoparquet(tables, path, extent, row_group_size):
+    writer = None
+    try:
+        for table in _rechunk(tables, row_group_size):
+            table = _with_geometry(table, covering=True)
+            if writer is None:
+                schema = table.schema.with_metadata({b'geo': json.dumps(_geo_metadata(extent)).encode()})
+                writer = pq.ParquetWriter(path, schema, compression='zstd')
+            writer.write_table(table.cast(writer.schema), row_group_size=row_group_size)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _write_flatgeobuf(tables, path, row_group_size):
+    from pyogrio import write_arrow
+
+    def fgb_batches():
+        for table in _rechunk(tables, row_group_size):
+            table = _with_geometry(table, covering=False)
+            # GDAL has no unsigned 64 bit fields, such ids are written as text
+            table = table.cast(pa.schema([pa.field(f.name, pa.string()) if f.type == pa.uint64() else f
+                                          for f in table.schema]))
+            yield from table.to_batches()
+
+    batches = fgb_batches()
+    first = next(batches, None)
+    if first is None:
+        return
+    def all_batches():
+        yield first
+        yield from batches
+    reader = pa.RecordBatchReader.from_batches(first.schema, all_batches())
+    write_arrow(reader, path, driver='FlatGeobuf', geometry_name='geometry', geometry_type='Point',
+                crs='EPSG:4326')
+
+
+def export_points(batches, path, format=None, bbox=WORLD, order=24, row_group_size=50000,
+                  run_rows=2000000, tmp_dir=None):
+    """
+    Write GEDI points sorted along a Hilbert curve to GeoParquet or FlatGeobuf.
+
+    batches: iterable of polars DataFrames or Arrow tables/record batches
+    with longitude and latitude columns, e.g. gedil2.iter_batches().
+    format: 'geoparquet' or 'flatgeobuf', from the file extension by default.
+    row_group_size: rows per parquet row group (FlatGeobuf batch); smaller
+    groups have tighter bbox statistics.
+    run_rows: rows sorted in memory at once, larger inputs are sorted
+    externally in `tmp_dir`.
+
+    GeoParquet files carry WKB point geometries, a bbox covering column and
+    the GeoParquet 1.1 'geo' metadata. Returns the number of rows written.
+    """
+    if format is None:
+        format = 'flatgeobuf' if path.endswith('.fgb') else 'geoparquet'
+    if format not in ('geoparquet', 'flatgeobuf'):
+        raise ValueError(f"Unsupported format '{format}', use 'geoparquet' or 'flatgeobuf'")
+    tmp_dir = tempfile.mkdtemp(prefix='gedi-export-', dir=tmp_dir)
+    try:
+        runs, extent = _sorted_runs(batches, bbox, order, run_rows, tmp_dir)
+        rows = 0
+
+        def counted():
+            nonlocal rows
+            for table in _merge_runs(runs):
+                rows += table.num_rows
+                yield table
+        if not runs:
+            return 0
+        if format == 'geoparquet':
+            _write_geoparquet(counted(), path, extent, row_group_size)
+        else:
+            _write_flatgeobuf(counted(), path, row_group_size)
+        return rows
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,219 @@
+"""
+Sharded, resumable batch extraction of GEDI points.
+
+Plans the partitions (1x1 degree tile and year/month) of a job from
+lookup.fgb, takes every N-th one for shard i and writes each partition to
+its own file in the output directory. Finished partitions are appended to a
+journal, so a preempted shard picks up where it stopped:
+
+    python extract.py job.json --shard 3/16
+    python extract.py job.json --shard 3/16 --plan     # list the work, read nothing
+
+The job spec is a JSON file:
+
+    {"geometry": "aoi.gpkg",                 # any vector file, or "bbox": [xmin, ymin, xmax, ymax]
+     "years": [2020, 2021],                  # or "start_dt"/"end_dt" and optional "months"
+     "columns": ["rh98", "cover", "longitude", "latitude"],   # or "*"
+     "quality": "good",                      # optional, see quality.py
+     "format": "parquet",                    # or "geoparquet" / "flatgeobuf"
+     "out_dir": "/scratch/gedi/amazon"}
+
+Remaining keys (lookup_file, dataset, engine, ...) are passed to func.gedil2.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from stats import QueryStats, partition_label
+
+SPEC_KEYS = ('geometry', 'bbox', 'years', 'start_dt', 'end_dt', 'months', 'columns', 'quality', 'format', 'out_dir')
+EXTENSIONS = {'parquet': '.parquet', 'geoparquet': '.parquet', 'flatgeobuf': '.fgb'}
+
+
+def load_spec(path):
+    with open(path) as f:
+        spec = json.load(f)
+    if 'out_dir' not in spec or ('geometry' not in spec and 'bbox' not in spec):
+        raise ValueError('the job spec needs "out_dir" and "geometry" or "bbox"')
+    if spec.get('format', 'parquet') not in EXTENSIONS:
+        raise ValueError(f"Unsupported format '{spec['format']}', use {', '.join(EXTENSIONS)}")
+    if 'years' in spec and ('start_dt' in spec or 'end_dt' in spec):
+        raise ValueError('give either "years" or "start_dt"/"end_dt"')
+    return spec
+
+
+def spec_hash(spec):
+    # what the output depends on; a journal is only resumed by the same job
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def parse_shard(text):
+    i, n = (int(v) for v in text.split('/'))
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f'shard {text}: need 0 <= i < N')
+    return i, n
+
+
+def _geometry(spec):
+    from shapely.geometry import box
+    if 'bbox' in spec:
+        return box(*spec['bbox'])
+    import geopandas as gpd
+    frame = gpd.read_file(spec['geometry'])
+    if frame.crs is not None:
+        frame = frame.to_crs(4326)
+    return frame.geometry.union_all()
+
+
+def make_reader(spec):
+    import func
+    kwargs = {k: v for k, v in spec.items() if k not in SPEC_KEYS}
+    if os.path.isdir(kwargs.get('dataset') or ''):
+        # a mirror of the partitioned dataset on a shared disk
+        import fsspec
+        kwargs['fs'] = fsspec.filesystem('file')
+    years = spec.get('years')
+    if years is not None:
+        kwargs.update(start_dt=f'{min(years)}-01-01', end_dt=f'{max(years)}-12-31')
+    else:
+        kwargs.update({k: spec[k] for k in ('start_dt', 'end_dt', 'months') if k in spec})
+    return func.gedil2(_geometry(spec), quality=spec.get('quality'), **kwargs)
+
+
+def plan(reader, years=None):
+    """Partitions of the job in a fixed order, as func.gedil2 partition arguments."""
+    args = reader._partition_args()
+    if years is not None:
+        years = {int(y) for y in years}
+        # whole tiles (the window spans the dataset) are split into the wanted years,
+        # year/month blocks outside the wanted years are dropped
+        args = [a for arg in args
+                for a in ([(arg, str(y)) for y in sorted(years)] if isinstance(arg, str) else [arg])
+                if int(a[1][:4]) in years]
+    return sorted(args, key=partition_label)
+
+
+def shard_of(args, shard):
+    # round robin over the sorted work list: neighbouring tiles go to different nodes
+    i, n = shard
+    return args[i::n]
+
+
+class Journal:
+    #=================================================================
+    # Append-only record of the partitions a shard has finished
+    #=================================================================
+    # One JSON line per partition, flushed and synced before the next one
+    # starts. The first line holds the job hash, so a changed job spec is
+    # not resumed on top of the old output.
+
+    def __init__(self, out_dir, shard, job):
+        i, n = shard
+        self.path = os.path.join(out_dir, '_journal', f'shard-{i}-of-{n}.jsonl')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line of a killed run
+                    continue
+                if 'job' in entry:
+                    if entry['job'] != job:
+                        raise SystemExit(f'{self.path} belongs to another job spec, use a new out_dir '
+                                         f'or delete the journal to start over')
+                else:
+                    self.done[entry['partition']] = entry
+        else:
+            self._append({'job': job, 'shard': f'{i}/{n}', 'created': time.time()})
+
+    def _append(self, entry):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def finish(self, partition, **entry):
+        entry = dict(entry, partition=partition, finished=time.time())
+        self._append(entry)
+        self.done[partition] = entry
+
+
+def output_path(out_dir, arg, format='parquet'):
+    tile, block = (arg, 'all') if isinstance(arg, str) else arg
+    return os.path.join(out_dir, tile, f'{block}{EXTENSIONS[format]}')
+
+
+def extract_partition(reader, arg, columns, out_dir, format='parquet'):
+    """Read one partition and write it atomically, returns (file or None, rows)."""
+    import pyarrow.parquet as pq
+    from export import export_points
+    stats = QueryStats(partition_label(arg), reader.hooks)
+    table = reader._read_parallel([arg], columns, stats=stats)
+    if table is None or table.num_rows == 0:
+        return None, 0
+    path = output_path(out_dir, arg, format)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a file under its final name is always complete
+    tmp = f'{path}.{os.getpid()}.tmp'
+    if format == 'parquet':
+        pq.write_table(table, tmp, compression='zstd')
+    else:
+        export_points([table], tmp, format)
+    os.replace(tmp, path)
+    return path, table.num_rows
+
+
+def run(spec, shard, threads=1, dry_run=False, out=sys.stdout):
+    reader = make_reader(spec)
+    args = shard_of(plan(reader, spec.get('years')), shard)
+    journal = Journal(spec['out_dir'], shard, spec_hash(spec))
+    todo = [arg for arg in args if partition_label(arg) not in journal.done]
+    print(f'shard {shard[0]}/{shard[1]}: {len(args)} partitions, {len(args) - len(todo)} done, {len(todo)} to do',
+          file=out)
+    if dry_run:
+        for arg in todo:
+            print(partition_label(arg), file=out)
+        return journal
+    columns = spec.get('columns', '*')
+    format = spec.get('format', 'parquet')
+
+    def work(arg):
+        t = time.time()
+        path, rows = extract_partition(reader, arg, columns, spec['out_dir'], format)
+        journal.finish(partition_label(arg), file=path and os.path.relpath(path, spec['out_dir']),
+                       rows=rows, seconds=time.time() - t)
+        print(f'{partition_label(arg)}: {rows} points in {time.time() - t:.1f} s', file=out)
+
+    # partitions of one shard run on threads, the readers release the GIL while fetching
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(work, todo):
+            pass
+    rows = sum(entry['rows'] for entry in journal.done.values())
+    print(f'shard {shard[0]}/{shard[1]} complete: {len(journal.done)} partitions, {rows} points', file=out)
+    return journal
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('spec', help='job spec (JSON)')
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1), metavar='i/N',
+                        help='run the i-th of N shards, 0 <= i < N (default 0/1: everything)')
+    parser.add_argument('--threads', type=int, default=1, help='partitions extracted concurrently')
+    parser.add_argument('--plan', action='store_true', help='print the partitions still to do and exit')
+    args = parser.parse_args(argv)
+    run(load_spec(args.spec), args.shard, threads=args.threads, dry_run=args.plan)
+
+
+if __name__ == '__main__':
+    main()
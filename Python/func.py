@@ -1,14 +1,75 @@
 from shapely.geometry import Point, Polygon, MultiPolygon, LineString
-from pyarrow.dataset import dataset
-from s3fs import S3FileSystem
+import shapely
+import math
+import os
+import contextlib
+import fsspec
+from pyarrow.dataset import dataset, ParquetFragmentScanOptions
 import polars as pl
+import polars.selectors as cs
+import pyarrow as pa
 import pandas as pd
 import numpy as np
 from collections import defaultdict
-from joblib import Parallel, delayed
+from concurrent.futures import ThreadPoolExecutor
+from cache import resolve_cache
+from catalog import get_catalog
+from partitions import HiveDataset
+from spatial import is_areal, dataset_subset, prune_row_groups, bbox_expression, points_in_geometry, filter_frame
+from timewindow import TimeWindow
+from columns import GEDI_COLUMNS, SCALE_FACTORS, load_scale_factors
+from quality import QualityFilter
+from export import export_points, WORLD
+from ipc import write_ipc, open_ipc
+from aio import AsyncReader, column_ranges
+from stats import QueryStats, partition_label
+from grid import parse_stats, cells_per_degree, group_keys, cell_exprs, partial_aggs, percentile_aggs, merge_partials, empty_partials, finalize
+
+SCALED_COLUMNS = list(SCALE_FACTORS)
+# read coalescing of the pyarrow parquet scanner (hole and range size limits)
+SCAN_CACHE = ParquetFragmentScanOptions().cache_options
+
+def _scale_exprs(names):
+    return [pl.col(col)*SCALE_FACTORS[col] for col in names if col in SCALE_FACTORS]
+
+def _scale_frame(df):
+    # scale only the encoded columns present in a (projected) frame
+    return df.with_columns(_scale_exprs(df.columns))
+
+def _to_output(table, output='pandas'):
+    # hand out an Arrow table as pandas (Arrow-backed dtypes), polars or Arrow
+    if table is None:
+        return None
+    if output == 'arrow':
+        return table
+    if output == 'polars':
+        return pl.from_arrow(table, rechunk=False)
+    if output == 'pandas':
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    raise ValueError(f"Unsupported output '{output}', use 'pandas', 'polars' or 'arrow'")
+
+def _tile_name(lon, lat):
+    # 1x1 degree tile named by its south-west corner
+    lon_str = f'{str(lon).zfill(3)}E' if lon>=0 else f'{str(-lon).zfill(3)}W'
+    lat_str = f'{str(lat).zfill(2)}N' if lat>=0 else f'{str(-lat).zfill(2)}S'
+    return f"{lon_str}_{lat_str}"
+
+def _covered_tiles(tiles, catalog):
+    # keep the 1x1 degree tiles that fall in a tile listed in the lookup catalog
+    table = catalog.table
+    size = int(round(table.geometry.iloc[0].bounds[2] - table.geometry.iloc[0].bounds[0]))
+    covered = set(zip(table['lon'].astype(int), table['lat'].astype(int)))
+    return [(lon, lat) for lon, lat in tiles if (lon // size * size, lat // size * size) in covered]
 
 # Convert from geometry to 1x1 degree tiles 
-def geometry_to_tile_indices(geometry):
+def geometry_to_tile_indices(geometry, exact=False, catalog=None):
+    """
+    Names of the 1x1 degree tiles covering `geometry`.
+
+    exact=False lists every tile in the bounding box; exact=True intersects
+    each part of the geometry with the tile grid and keeps only the tiles it
+    touches. If a LookupCatalog is given, tiles without data are dropped.
+    """
     # Convert different geometry types to bounding box
     if isinstance(geometry, Point):
         bbox = geometry.buffer(1e-10)  # Buffer by 1 degree for points
@@ -19,18 +80,30 @@ def geometry_to_tile_indices(geometry):
     else:
         raise ValueError("Unsupported geometry type")
 
-    # Extract bounding box coordinates
-    xmin, ymin, xmax, ymax = bbox.bounds
+    parts = shapely.get_parts(geometry) if exact else [bbox]
+    tiles = set()
+    for part in parts:
+        # floor, not int(): -0.5 lies in the tile starting at -1
+        xmin, ymin, xmax, ymax = part.bounds
+        lons, lats = np.meshgrid(np.arange(math.floor(xmin), math.floor(xmax) + 1),
+                                 np.arange(math.floor(ymin), math.floor(ymax) + 1), indexing='ij')
+        lons, lats = lons.ravel(), lats.ravel()
+        if exact:
+            shapely.prepare(part)
+            boxes = shapely.box(lons, lats, lons + 1, lats + 1)
+            hit = shapely.intersects(part, boxes)
+            if part.area > 0:
+                # a polygon only sharing an edge with a tile has no points in it
+                hit &= ~shapely.touches(part, boxes)
+            lons, lats = lons[hit], lats[hit]
+        tiles.update(zip(lons.tolist(), lats.tolist()))
 
-    lat_indices = range(int(ymin), int(ymax) + 1)
-    lon_indices = range(int(xmin), int(xmax) + 1)
-    lat_indices_str = [f'{str(i).zfill(2)}N' if i>=0 else f'{str(-i).zfill(2)}S' for i in lat_indices]
-    lon_indices_str = [f'{str(i).zfill(3)}E' if i>=0 else f'{str(-i).zfill(3)}W' for i in lon_indices]
+    tiles = sorted(tiles)
+    if catalog is not None:
+        tiles = _covered_tiles(tiles, catalog)
 
     # Create a list of 1x1 degree lat lon index strings
-    lat_lon_indices = [f"{lon}_{lat}" for lon in lon_indices_str for lat in lat_indices_str]
-
-    return lat_lon_indices
+    return [_tile_name(lon, lat) for lon, lat in tiles]
 
 # aggregating months throughout the whole year
 def shorten_year_months(strings):
@@ -53,139 +126,543 @@ def shorten_year_months(strings):
 
 
 class gedil2:
-    def __init__(self,geom,start_dt='2019-04-18',end_dt='2023-03-16',n_jobs=-5):
-        self.object = 'gedi-ard/level2/gedi.l2v002_pnt_20190418_20230316_go_epsg.4326_v20231219.parquet'
-        self.fs = S3FileSystem(
+    def __init__(self,geom,start_dt='2019-04-18',end_dt='2023-03-16',n_jobs=-5,cache=None,io_threads=32,
+                 exact_tiles=True,lookup_file='lookup.fgb',listing_ttl=24*3600,
+                 engine='async',net_concurrency=64,cpu_threads=4,
+                 dataset=None,fs=None,hooks=None,months=None,quality=None):
+        # dataset root and filesystem can point to a mirror or a local stand-in
+        self.object = dataset or 'gedi-ard/level2/gedi.l2v002_pnt_20190418_20230316_go_epsg.4326_v20231219.parquet'
+        if fs is None:
+            # s3fs (aiobotocore) is only imported when the public bucket is used
+            from s3fs import S3FileSystem
+            fs = S3FileSystem(
                       endpoint_url='https://s3.eu-central-1.wasabisys.com',
-                      anon=True)
+                      anon=True,
+                      config_kwargs={'max_pool_connections': net_concurrency})
+        self.fs = fs
         self.geom = geom
-        if start_dt != '2019-04-18' or end_dt != '2023-03-16':
-            self.period_range = pd.period_range(start=start_dt, end=end_dt, freq='M')
-        else:
-            self.period_range = None
+        # start_dt/end_dt may be dates or timestamps (a date includes its whole day),
+        # months restricts the window to these months of every year, e.g. [5,6,7,8,9]
+        self.window = TimeWindow(start_dt, end_dt, months)
+        # shot filters pushed into the scan: a preset ('good', 'strict', ...), a dict
+        # of column conditions in physical units or a list of both, see quality.py
+        self.quality = QualityFilter(quality)
         self.n_jobs = n_jobs
+        # opt-in local partition cache (None, True, a directory or a PartitionCache)
+        self.cache = resolve_cache(cache)
+        self.io_threads = io_threads
+        self.exact_tiles = exact_tiles
+        self.lookup_file = lookup_file
+        self.listing_ttl = listing_ttl
+        # 'async': concurrent range requests + decode threads, 'joblib': worker processes
+        self.engine = engine
+        self.net_concurrency = net_concurrency
+        self.cpu_threads = cpu_threads
+        self._meta = {}
+        self._partitions = None
+        # callables hook(name, start, end, attributes) receiving every timed span
+        self.hooks = hooks
+        # QueryStats of the latest retrieve, scan or iter_batches
+        self.stats = None
 
-    def _meta_reader(self,arg):
-        try:
-            if isinstance(arg,str):
-                pyarrow_dataset = self._read_parititon(arg)
-            else:
-                pyarrow_dataset = self._read_parititon(*arg)
-            df_default=self._gedi_read_default(pyarrow_dataset)
-            row_counts=df_default.select((pl.col('rg'))).collect().shape[0]
-            return df_default, row_counts
-        except FileNotFoundError:
-            return None
+    def _new_stats(self, query):
+        self.stats = QueryStats(query, self.hooks)
+        return self.stats
+
+    def __getstate__(self):
+        # hooks stay in the calling process, workers report through their own QueryStats;
+        # the footer metadata is left out too, every task gets its partition's meta passed
+        state = self.__dict__.copy()
+        state['hooks'] = None
+        state['stats'] = None
+        state['_meta'] = {}
+        return state
+
+    @property
+    def partitions(self):
+        # hive-partitioned view of the whole parquet root, built on first use
+        if self._partitions is None or self._partitions.fs is not self.fs or self._partitions.root != self.object:
+            self._partitions = HiveDataset(self.fs, self.object, ttl=self.listing_ttl)
+        return self._partitions
+
+    def _partition_meta(self,arg,stats=None):
+        # footer metadata of one partition, None if the partition does not exist
+        stats = QueryStats() if stats is None else stats
+        with stats.span('listing', partition_label(arg)):
+            try:
+                pyarrow_dataset = self._read_parititon(arg) if isinstance(arg, str) else self._read_parititon(*arg)
+            except FileNotFoundError:
+                return None
+            fragments = list(pyarrow_dataset.get_fragments())
+            metadata = [fragment.metadata for fragment in fragments]
+        # one footer request per file
+        stats.add(requests=len(metadata), bytes_transferred=sum(md.serialized_size for md in metadata))
+        return {'arg': arg, 'dataset': pyarrow_dataset, 'metadata': metadata,
+                'num_rows': sum(md.num_rows for md in metadata)}
+
+    def _scan_partitions(self,args,stats=None):
+        # read partition footers concurrently and keep them for the data read
+        stats = QueryStats() if stats is None else stats
+        todo = [arg for arg in args if arg not in self._meta]
+        if todo:
+            with stats.span('listing'):
+                self.partitions.dataset()
+            with ThreadPoolExecutor(max_workers=self.io_threads) as executor:
+                for arg, meta in zip(todo, executor.map(lambda arg: self._partition_meta(arg, stats), todo)):
+                    self._meta[arg] = meta
+        metas = [self._meta[arg] for arg in args if self._meta[arg] is not None]
+        stats.add(partitions_planned=len(args),
+                  partitions_pruned=len(args) - sum(meta['num_rows'] > 0 for meta in metas))
+        return metas
         
     def _read_parititon(self, tile, year_month=None):
+        # select the partition from the cached hive listing, no S3 LIST per call
+        year = month = None
         if year_month is not None:
             if '-' in year_month:
                 year,month = list(map(lambda x:int(x), year_month.split('-'))) 
-                subset_path = self.object + f'/tile={tile}/year={year}/month={month}'
             else:
-                year = year_month
-                subset_path = self.object + f'/tile={tile}/year={year}'
+                year = int(year_month)
+        pyarrow_dataset = self.partitions.select(tile, year, month)
+        if pyarrow_dataset is None:
+            raise FileNotFoundError(f'{self.object}/tile={tile}' + (f'/year={year}' if year else '') + (f'/month={month}' if month else ''))
+        # footers are always read from self.fs, only the data reads go through the cache
+        return pyarrow_dataset
 
-        else:
-            subset_path = self.object + f'/tile={tile}'
-        pyarrow_dataset = dataset(
-        source = subset_path,
-        format = 'parquet',
-        filesystem=self.fs
-        )
+    def _cached_file(self, path, lease):
+        # local copy of a partition file, fetched from S3 on a miss and leased until the read is done
+        return self.cache.get(self.object, path, lambda local_path: self.fs.get_file(path, local_path), lease)
+
+    def _lease(self):
+        # cache lease covering one read, so its files are not evicted while in use
+        return self.cache.lease() if self.cache is not None else contextlib.nullcontext()
+
+    @contextlib.contextmanager
+    def _data_source(self, meta):
+        # dataset the points of a partition are read from: the remote files or their cached copies
+        pyarrow_dataset = meta['dataset']
+        if self.cache is None:
+            yield pyarrow_dataset
+            return
+        with self._lease() as lease:
+            yield dataset([self._cached_file(f, lease) for f in pyarrow_dataset.files], format='parquet',
+                          schema=pyarrow_dataset.schema)
 
-        return pyarrow_dataset
-    
     def _gedi_read_default(self,pyarrow_dataset):
         # scale each column accroding to the converters using for preprocessing
-        default_ds = pl.scan_pyarrow_dataset(pyarrow_dataset).with_columns((pl.col("rh100","rh99","rh98",'rh97',"rh95",'rh75','rh50','rh25','sensitivity',
-                                                                         "rh100_a1","rh99_a1","rh98_a1","rh97_a1","rh95_a1",'rh75_a1','rh50_a1','rh25_a1',
-                                                                         "rh100_a2","rh99_a2","rh98_a2","rh97_a2","rh95_a2",'rh75_a2','rh50_a2','rh25_a2',
-                                                                         "rh100_a3","rh99_a3","rh98_a3","rh97_a3","rh95_a3",'rh75_a3','rh50_a3','rh25_a3',
-                                                                         "rh100_a4","rh99_a4","rh98_a4","rh97_a4","rh95_a4",'rh75_a4','rh50_a4','rh25_a4',
-                                                                         "rh100_a5","rh99_a5","rh98_a5","rh97_a5","rh95_a5",'rh75_a5','rh50_a5','rh25_a5',
-                                                                         "rh100_a6","rh99_a6","rh98_a6","rh97_a6","rh95_a6",'rh75_a6','rh50_a6','rh25_a6',
-                                                                         'sensitivity_a1','sensitivity_a2','sensitivity_a3','sensitivity_a4','sensitivity_a5','sensitivity_a6',
-                                                                          "omega","pgap_theta","cover","rhog","rhov"
-                                                                         )*0.0001,
-                                                                   pl.col('elev_lowestmode',
-                                                                         'elev_lowestmode_a1','elev_lowestmode_a2','elev_lowestmode_a3','elev_lowestmode_a4','elev_lowestmode_a5','elev_lowestmode_a6',
-                                                                         'fhd_normal')*0.01,
-                                                                   pl.col('rg','rv')*0.1,
-                                                                   pl.col('pai')*0.001))
-        return default_ds
+        df = pl.scan_pyarrow_dataset(pyarrow_dataset)
+        return df.with_columns(_scale_exprs(pyarrow_dataset.schema.names))
+
+    def _partition_args(self, tiles=None):
+        if tiles is None:
+            # skip tiles without data when the lookup table is available
+            catalog = get_catalog(self.lookup_file) if self.lookup_file and os.path.exists(self.lookup_file) else None
+            tiles = geometry_to_tile_indices(self.geom, exact=self.exact_tiles, catalog=catalog)
+        # fewest year and month partitions covering the time window
+        time_blocks = self.window.blocks()
+        if time_blocks is None:
+            return tiles
+        return [(tile,year_month) for tile in tiles for year_month in time_blocks]
+
+    def _kept_row_groups(self, md):
+        # row groups whose footer statistics overlap the AOI and the time window and may pass the quality filter
+        row_groups = prune_row_groups(md, self.geom.bounds) if is_areal(self.geom) else range(md.num_row_groups)
+        return self.quality.prune_row_groups(md, self.window.prune_row_groups(md, row_groups))
+
+    @contextlib.contextmanager
+    def _pruned_dataset(self, meta):
+        # drop row groups outside the AOI and time window using the footer statistics
+        with self._data_source(meta) as source:
+            yield dataset_subset(source, meta['metadata'], [self._kept_row_groups(md) for md in meta['metadata']])
+
+    def _filter_expression(self):
+        # bbox, delta_time and quality predicates for the pyarrow scanner, None if there is nothing to filter
+        expressions = [bbox_expression(self.geom.bounds) if is_areal(self.geom) else None,
+                       self.window.expression(), self.quality.expression()]
+        expression = None
+        for e in expressions:
+            if e is not None:
+                expression = e if expression is None else expression & e
+        return expression
+
+    def iter_batches(self, columns="*", batch_size=65536, output='polars', raw=False):
+        """
+        Stream the query result partition by partition.
+
+        Yields scaled polars DataFrames (output='polars') or Arrow
+        RecordBatches (output='arrow') of at most `batch_size` rows, so only
+        a few batches are held in memory at any time. raw=True skips the
+        scaling, see scale_factors().
+        """
+        areal = is_areal(self.geom)
+        stats = self._new_stats('iter_batches')
+        for meta in self._scan_partitions(self._partition_args(), stats):
+            if meta['num_rows'] == 0:
+                continue
+            label = partition_label(meta['arg'])
+            with self._pruned_dataset(meta) as pyarrow_dataset:
+                names = pyarrow_dataset.schema.names if columns == '*' else list(columns)
+                read = names + [c for c in ('longitude', 'latitude') if areal and c not in names]
+                batches = pyarrow_dataset.to_batches(columns=read, batch_size=batch_size,
+                                                     filter=self._filter_expression(),
+                                                     batch_readahead=2, fragment_readahead=1)
+                stats.add(partitions_read=1)
+                while True:
+                    # fetch and decode happen together in the pyarrow scanner
+                    with stats.span('fetch', label):
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    stats.add(bytes_decoded=batch.nbytes)
+                    with stats.span('assemble', label):
+                        df = pl.from_arrow(batch)
+                        if areal:
+                            df = df.filter(points_in_geometry(self.geom, df['longitude'].to_numpy(),
+                                                              df['latitude'].to_numpy())).select(names)
+                        if not raw:
+                            df = _scale_frame(df)
+                    if df.height == 0:
+                        continue
+                    stats.add(rows=df.height)
+                    if output == 'arrow':
+                        # a filtered or scaled frame can span several chunks
+                        yield from df.to_arrow().to_batches()
+                    else:
+                        yield df
+        stats.finish()
+
+    def export(self, path, columns="*", format=None, raw=False, **kwargs):
+        """
+        Stream the query into a GeoParquet or FlatGeobuf file sorted along a
+        Hilbert curve, with bounded memory. See export.export_points for the
+        options (row_group_size, run_rows, tmp_dir). Returns the rows written.
+        """
+        if columns != '*':
+            columns = list(dict.fromkeys([*columns, 'longitude', 'latitude']))
+        # a finer curve over the AOI than over the whole world
+        bbox = self.geom.bounds if is_areal(self.geom) else WORLD
+        return export_points(self.iter_batches(columns, output='arrow', raw=raw), path, format, bbox=bbox, **kwargs)
+
+    def _finish(self, df, columns, downcast=False, raw=False):
+        # filter and project the raw frame, then scale only the returned columns
+        if is_areal(self.geom):
+            df = filter_frame(df, self.geom)
+        if self.window.predicate() is not None:
+            df = df.filter(self.window.predicate())
+        if self.quality:
+            df = df.filter(self.quality.predicate())
+        names = df.collect_schema().names() if columns == '*' else list(columns)
+        df = df.select(names)
+        if not raw:
+            df = df.with_columns(_scale_exprs(names))
+            if downcast:
+                df = df.with_columns(cs.by_name(SCALED_COLUMNS, require_all=False).cast(pl.Float32))
+        return df.collect().to_arrow()
+
+    def _empty_table(self, columns, downcast=False, raw=False):
+        # no points: a table with the columns and types a read would have returned
+        df = pl.from_arrow(self.partitions.schema.empty_table()).lazy()
+        return self._finish(df, columns, downcast, raw)
+
+    def _read_columns(self, columns):
+        # columns to read: the requested ones plus the coordinates for the spatial filter
+        if columns == '*':
+            return None
+        extra = (['longitude', 'latitude'] if is_areal(self.geom) else []) + \
+                (['delta_time'] if self.window.predicate() is not None else []) + self.quality.columns
+        return list(dict.fromkeys([*columns, *extra]))
+
+    def _row_groups(self, meta):
+        # (path, metadata, row groups) of the files of a partition that may hold points of the AOI
+        files = []
+        for path, md in zip(meta['dataset'].files, meta['metadata']):
+            row_groups = self._kept_row_groups(md)
+            if row_groups:
+                files.append((path, md, row_groups))
+        return files
+
+    def _read_table(self, meta, columns, downcast=False, raw=False):
+        # read one partition into an Arrow table with its native dtypes; runs in
+        # a worker process, so it returns its own QueryStats for the caller to merge
+        stats = QueryStats()
+        label = partition_label(meta['arg'])
+        files = self._row_groups(meta)
+        if not files:
+            stats.add(partitions_pruned=1)
+            return None, stats
+        names = self._read_columns(columns)
+        # what the scanner requests: the column chunks of the kept row groups, coalesced
+        # with the scanner's own limits so the counts match the reads at the filesystem
+        ranges = [r for path, md, row_groups in files
+                  for r in column_ranges(md, row_groups, names, SCAN_CACHE.hole_size_limit, SCAN_CACHE.range_size_limit)]
+        stats.add(partitions_read=1, requests=len(ranges), bytes_transferred=sum(end - start for start, end in ranges))
+        # fetch and decode happen together in the pyarrow scanner
+        with stats.span('fetch', label), self._pruned_dataset(meta) as pyarrow_dataset:
+            table = pyarrow_dataset.to_table(columns=names, filter=self._filter_expression())
+        stats.add(bytes_decoded=table.nbytes)
+        with stats.span('assemble', label):
+            table = self._finish(pl.from_arrow(table).lazy(), columns, downcast, raw)
+        return table, stats
+
+    def _read_async(self, metas, columns, downcast=False, raw=False, stats=None):
+        # fetch the needed column chunks as byte ranges and decode on threads
+        stats = QueryStats() if stats is None else stats
+
+        def finish(tables):
+            df = pl.from_arrow(pa.concat_tables(tables)).lazy()
+            return self._finish(df, columns, downcast, raw)
+
+        fs = fsspec.filesystem('file') if self.cache is not None else self.fs
+        reader = AsyncReader(fs, net_concurrency=self.net_concurrency, cpu_threads=self.cpu_threads)
+        with self._lease() as lease:
+            tasks, labels = [], []
+            for meta in metas:
+                files = self._row_groups(meta)
+                if files:
+                    if self.cache is not None:
+                        files = [(self._cached_file(path, lease), md, row_groups) for path, md, row_groups in files]
+                    tasks.append(files)
+                    labels.append(partition_label(meta['arg']))
+            stats.add(partitions_read=len(tasks), partitions_pruned=len(metas) - len(tasks))
+            return reader.read(tasks, self._read_columns(columns), finish, stats, labels)
+
+    def _read_tables(self, metas, columns, downcast=False, raw=False, stats=None):
+        # one Arrow table (or None) per partition from the configured engine
+        stats = QueryStats() if stats is None else stats
+        if self.engine == 'async':
+            return self._read_async(metas, columns, downcast, raw, stats)
+        n_jobs = 1 if len(metas) < 5 else self.n_jobs
+        from joblib import Parallel, delayed
+        results = Parallel(n_jobs=n_jobs)(delayed(self._read_table)(meta, columns, downcast, raw) for meta in metas)
+        tables = []
+        for table, worker_stats in results:
+            stats.merge(worker_stats)
+            tables.append(table)
+        return tables
+
+    def _read_parallel(self,args,columns,downcast=False,raw=False,stats=None):
+        # concatenate per-partition Arrow tables without copying their buffers
+        stats = QueryStats() if stats is None else stats
+        metas = [meta for meta in self._scan_partitions(args, stats) if meta['num_rows'] > 0]
+        tables = [t for t in self._read_tables(metas, columns, downcast, raw, stats) if t is not None]
+        if not tables:
+            stats.finish()
+            return self._empty_table(columns, downcast, raw)
+        table = pa.concat_tables(tables, promote_options='permissive')
+        stats.add(rows=table.num_rows)
+        stats.finish()
+        print(f'compiled data from {len(tables)} of {len(args)} paritions {table.num_rows} points')
+        return table
+
+    def _spill_ipc(self, args, columns, path, downcast=False, raw=False, stats=None):
+        # read the partitions a few at a time and append them to an IPC file,
+        # so memory holds one group of partitions instead of the whole result
+        stats = QueryStats() if stats is None else stats
+        metas = [meta for meta in self._scan_partitions(args, stats) if meta['num_rows'] > 0]
+        group = max(self.cpu_threads, 1) * 2
+
+        def tables():
+            for i in range(0, len(metas), group):
+                yield from self._read_tables(metas[i:i + group], columns, downcast, raw, stats)
+        rows = write_ipc(tables(), path, self._empty_table(columns, downcast, raw).schema)
+        stats.add(rows=rows)
+        stats.finish()
+        print(f'wrote {rows} points from {len(metas)} of {len(args)} paritions to {path}')
+        return open_ipc(path)
+
+    def scale_factors(self, columns="*"):
+        """Scale factors of the integer-encoded columns among `columns`."""
+        if columns == '*':
+            return dict(SCALE_FACTORS)
+        return {col: SCALE_FACTORS[col] for col in columns if col in SCALE_FACTORS}
+
+    def retrieve(self,columns="*",output='pandas',downcast=False,raw=False,path=None):
+        """
+        Read all points of the query.
+
+        output: 'pandas' (Arrow-backed dtypes), 'polars' or 'arrow'.
+        downcast: return the scaled metrics as float32 instead of float64.
+        raw: keep the stored integers unscaled and return (data, scale_factors).
+        path: write the partitions into this Arrow IPC file as they arrive and
+        return a memory-mapped view of it (use output='arrow' or 'polars' to
+        stay zero-copy), for results larger than memory. The file can be
+        reopened later with ipc.open_ipc(path).
+
+        A query without points returns an empty table with the requested
+        columns and types.
+
+        Partitions, requests, bytes and per-partition latency of the read
+        are recorded in self.stats. Shots rejected by the quality filter are
+        dropped inside the parquet scan, before scaling and concatenation.
+        """
+        if path is not None:
+            table = self._spill_ipc(self._partition_args(), columns, path, downcast, raw, self._new_stats('retrieve'))
+        else:
+            table = self._read_parallel(self._partition_args(),columns,downcast,raw,self._new_stats('retrieve'))
+        if raw:
+            return _to_output(table, output), self.scale_factors(columns)
+        return _to_output(table, output)
     
-    def _read_parallel(self,args,columns):
-        # use pointers to work with prodefined matrix
+    def _count_rows(self, meta, stats):
+        # rows of a partition passing the AOI, time window and quality filter,
+        # reading only the filter columns of the row groups that may match
+        label = partition_label(meta['arg'])
+        with stats.span('fetch', label), self._pruned_dataset(meta) as pyarrow_dataset:
+            if not is_areal(self.geom):
+                return pyarrow_dataset.count_rows(filter=self._filter_expression())
+            table = pyarrow_dataset.to_table(columns=['longitude', 'latitude'], filter=self._filter_expression())
+        stats.add(bytes_decoded=table.nbytes)
+        return int(points_in_geometry(self.geom, table['longitude'].to_numpy(), table['latitude'].to_numpy()).sum())
+
+    def scan(self,columns="*"):
+        """
+        Size of the query from parquet footers only, without reading any data.
+
+        Returns the schema, row counts, an estimate of the download size
+        (compressed bytes) and in-memory size of `columns`, and per-column
+        compressed/uncompressed bytes with min/max statistics, scaled like
+        retrieve(). Like retrieve(), only the row groups whose statistics may
+        match the AOI, time window and quality filter are counted.
+
+        With a quality filter, the filter columns (and coordinates of an areal
+        AOI) are read to count the shots passing it ('filtered row counts'),
+        and the memory estimate is based on that count.
+        """
+        stats = self._new_stats('scan')
+        metas = self._scan_partitions(self._partition_args(), stats)
+        filtered = None
+        if self.quality and metas:
+            with ThreadPoolExecutor(max_workers=self.io_threads) as executor:
+                filtered = sum(executor.map(lambda meta: self._count_rows(meta, stats), metas))
+            stats.add(rows=filtered)
+        stats.finish()
+        if not metas:
+            return {'schema': None, 'row counts': 0, 'filtered row counts': filtered, 'partitions': 0,
+                    'download bytes': 0, 'memory bytes': 0, 'columns': pd.DataFrame()}
+        schema = self._gedi_read_default(metas[0]['dataset']).collect_schema()
+        names = list(schema.names()) if columns == '*' else list(columns)
+
+        # only the row groups retrieve() reads: those kept by the AOI, time window and quality statistics
+        stats = {name: {'compressed bytes': 0, 'uncompressed bytes': 0, 'min': None, 'max': None} for name in names}
         row_counts = 0
-        df_list=[]
-        for result in Parallel(n_jobs=self.n_jobs)(delayed(self._meta_reader)(i) for i in args):
-            if result is not None:
-                df_list.append((result[0],columns))
-                row_counts+=result[1]
-        mat = np.zeros((row_counts,91)) if columns=='*' else np.zeros((row_counts,len(columns))) 
-
-        def worker(df,colums):
-            arr = df.select(pl.col(columns)).collect().to_numpy()
-            return arr 
-
-        print(f'compiling data from {len(args)} paritions {row_counts} points, please wait............')
-        pointer = 0
-        for result in Parallel(n_jobs=self.n_jobs)(delayed(worker)(*i) for i in df_list):
-            arr_slice = slice(pointer, pointer+len(result))
-            mat[arr_slice,:] = result 
-            pointer += len(result)
-        
-        return pd.DataFrame(mat) if columns=='*' else pd.DataFrame(mat,columns=columns)
-    def _read_meta_parallel(self,args):
-        # count row number to return the schema and counts of row
-        print('counting row number')
-        row_counts = 0        
-        for result in Parallel(n_jobs=self.n_jobs)(delayed(self._meta_reader)(i) for i in args):
-            if result is not None:
-                row_counts+=result[1]        
-        return {'schema':result[0].schema,'row counts':row_counts}
-    
-    def retrieve(self,columns="*"):
-        tiles = geometry_to_tile_indices(self.geom)
-        if self.period_range is not None:
-            period_range=self.period_range.strftime('%Y-%m').tolist()
-            time_blocks=shorten_year_months(period_range)
-            args = []
-            for tile in tiles:
-                for year_month in time_blocks:
-                    args.append((tile,year_month))
-            if len(args)<5:
-                df_list=[]
-                for i,arg in enumerate(args):
-                    df_list.append(_read_parititon(args).select(pl.col(columns)).collect().to_pandas())
-                final_pandas_df=pd.concat(df_list)
-            else:
-                final_pandas_df=self._read_parallel(args,columns)
+        for meta in metas:
+            for md in meta['metadata']:
+                for i in self._kept_row_groups(md):
+                    rg = md.row_group(i)
+                    row_counts += rg.num_rows
+                    for j in range(rg.num_columns):
+                        chunk = rg.column(j)
+                        entry = stats.get(chunk.path_in_schema)
+                        if entry is None:
+                            continue
+                        entry['compressed bytes'] += chunk.total_compressed_size
+                        entry['uncompressed bytes'] += chunk.total_uncompressed_size
+                        st = chunk.statistics
+                        if st is not None and st.has_min_max:
+                            entry['min'] = st.min if entry['min'] is None else min(entry['min'], st.min)
+                            entry['max'] = st.max if entry['max'] is None else max(entry['max'], st.max)
 
-            return final_pandas_df
-        
-        final_pandas_df=self._read_parallel(tiles,columns)
-        return final_pandas_df
-    
-    def scan(self):
-        tiles = geometry_to_tile_indices(self.geom)
-        df_list=[]
-        if self.period_range is not None:
-            period_range=self.period_range.strftime('%Y-%m').tolist()
-            time_blocks=shorten_year_months(period_range)
-            args = []
-            for tile in tiles:
-                for year_month in time_blocks:
-                    args.append((tile,year_month))
-
-            if len(args)<5:
-                row_counts=0
-                for arg in args:
-                    df,count = _meta_reader(arg)
-                    row_count += count 
-                return {'schema':df.schema,'row counts':row_counts}
+        # footer statistics are the stored integers, report them in physical units
+        for name, entry in stats.items():
+            if name in SCALE_FACTORS and entry['min'] is not None:
+                entry['min'], entry['max'] = entry['min'] * SCALE_FACTORS[name], entry['max'] * SCALE_FACTORS[name]
+
+        rows = row_counts if filtered is None else filtered
+        columns_df = pd.DataFrame.from_dict(stats, orient='index')
+        # in-memory size of the scaled result: bit width of fixed-width output dtypes,
+        # the uncompressed parquet size per row for strings, binary and lists
+        def memory_bytes(name):
+            try:
+                return pl.Series(dtype=schema[name]).to_arrow().type.bit_width * rows / 8
+            except ValueError:
+                return stats[name]['uncompressed bytes'] * rows / max(row_counts, 1)
+        columns_df['memory bytes'] = pd.Series({name: memory_bytes(name) for name in names}).astype(int)
+        return {'schema': schema, 'row counts': row_counts, 'filtered row counts': filtered, 'partitions': len(metas),
+                'download bytes': int(columns_df['compressed bytes'].sum()),
+                'memory bytes': int(columns_df['memory bytes'].sum()),
+                'columns': columns_df}
+
+    @staticmethod
+    def _aggregate_units(args, freq):
+        # group partitions so that no cell/time bin is split between two groups:
+        # a partition inside one time bin joins the other partitions of that bin
+        units = {}
+        for arg in args:
+            tile, block = (arg, None) if isinstance(arg, str) else arg
+            if freq is None:
+                key = tile
+            elif freq == 'year' and block is not None:
+                key = (tile, block[:4])
             else:
-                return self._read_meta_parallel(args)
+                key = arg
+            units.setdefault(key, []).append(arg)
+        return list(units.values())
+
+    def _aggregate_unit(self, metas, columns, keys, percentiles, n, freq, stats):
+        # partial aggregates of one group of partitions, streamed batch by batch
+        areal = is_areal(self.geom)
+        read = list(dict.fromkeys(['longitude', 'latitude', *(['delta_time'] if freq else []), *columns]))
+        acc, frames = None, []
+        for meta in metas:
+            label = partition_label(meta['arg'])
+            with self._pruned_dataset(meta) as pyarrow_dataset:
+                batches = pyarrow_dataset.to_batches(columns=read, filter=self._filter_expression(),
+                                                     batch_readahead=2, fragment_readahead=1)
+                stats.add(partitions_read=1)
+                while True:
+                    with stats.span('fetch', label):
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    stats.add(bytes_decoded=batch.nbytes)
+                    with stats.span('assemble', label):
+                        df = pl.from_arrow(batch)
+                        if areal:
+                            df = df.filter(points_in_geometry(self.geom, df['longitude'].to_numpy(),
+                                                              df['latitude'].to_numpy()))
+                        df = df.select(*cell_exprs(n, freq), *columns).with_columns(_scale_exprs(columns))
+                        stats.add(rows=df.height)
+                        if percentiles:
+                            # percentiles need the values, only the narrow cell/metric columns are kept
+                            frames.append(df)
+                        else:
+                            acc = merge_partials([acc, df.group_by(keys).agg(partial_aggs(columns))], keys, columns)
+        if percentiles and frames:
+            with stats.span('assemble'):
+                acc = pl.concat(frames).group_by(keys).agg(partial_aggs(columns) + percentile_aggs(columns, percentiles))
+        return acc
+
+    def aggregate(self, columns=('rh98', 'cover', 'pai'), stats=('count', 'mean', 'p50'), cell_size=0.01,
+                  freq='month', output='pandas'):
+        """
+        Gridded summary of the query without materializing the points.
+
+        columns: metrics to summarize, scaled like retrieve().
+        stats: 'count', 'mean', 'std', 'min', 'max', 'sum' and percentiles 'p0'..'p100'.
+        cell_size: cell edge in degrees, must divide one degree so cells align with the tiles.
+        freq: time bin, 'month', 'year' or None for the whole period.
+
+        Returns one row per non-empty cell (and time bin) with the cell centre
+        x/y, an empty table with the same columns if no shot matches. Partial aggregates are merged across batches, partitions and
+        workers, so memory is bounded by the number of cells. Percentiles are
+        exact: partitions sharing a time bin are read together, which bounds
+        memory by the values of one tile and time bin instead.
+        """
+        columns = list(columns)
+        moments, percentiles = parse_stats(stats)
+        n = cells_per_degree(cell_size)
+        keys = group_keys(freq)
+        query_stats = self._new_stats('aggregate')
+        metas = {meta['arg']: meta for meta in self._scan_partitions(self._partition_args(), query_stats)
+                 if meta['num_rows'] > 0}
+        units = [[metas[arg] for arg in unit if arg in metas]
+                 for unit in self._aggregate_units(list(metas), freq)]
 
-        return self._read_meta_parallel(tiles)
\ No newline at end of file
+        partials = None
+        with ThreadPoolExecutor(max_workers=self.cpu_threads) as executor:
+            for part in executor.map(lambda unit: self._aggregate_unit(unit, columns, keys, percentiles, n, freq, query_stats), units):
+                partials = merge_partials([partials, part], keys, columns, percentiles)
+        query_stats.finish()
+        if partials is None:
+            partials = empty_partials(keys, columns, percentiles, freq)
+        return _to_output(finalize(partials, keys, columns, moments, percentiles, n).to_arrow(), output)
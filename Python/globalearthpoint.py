@@ -1,30 +1,26 @@
 import os
 os.environ['USE_PYGEOS'] = '0'
-from pyarrow.dataset import dataset
-import polars as pl
-import pyarrow.fs as fs
-import geopandas as gpd
-import json
-import contextily as cx
-from shapely.geometry import shape
-import os
-import requests
-import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
-from tqdm import tqdm
-from joblib import Parallel, delayed
-import leafmap.foliumap as leafmap
-from urllib.parse import urlparse
-import math
+import sys
 import time
 import contextlib
-import joblib
+from urllib.parse import urlparse
+import polars as pl
+import pandas as pd
 from tqdm import tqdm
+# headless query core: geopandas, joblib, requests and the map stack (viz.py)
+# are imported on first use, so short-lived workers start quickly
+from catalog import get_catalog
+from cache import resolve_cache
+from spatial import filter_frame
+from stats import QueryStats
+from manifest import Manifest, dataset_version
+from export import export_points
+from quality import QualityFilter
 
 @contextlib.contextmanager
 def tqdm_joblib(tqdm_object):
     """Context manager to patch joblib to report into tqdm progress bar given as argument"""
+    import joblib
     class TqdmBatchCompletionCallback(joblib.parallel.BatchCompletionCallBack):
         def __call__(self, *args, **kwargs):
             tqdm_object.update(n=self.batch_size)
@@ -40,54 +36,29 @@ def tqdm_joblib(tqdm_object):
 
         
     
-#!pip install ipywidgets
-#!pip install jupyter-leaflet
-#!pip install --upgrade ipywidgets jupyter-leaflet
-#!jupyter nbextension enable --py widgetsnbextension --sys-prefix
-#!jupyter nbextension enable --py --sys-prefix ipyleaflet
-#!jupyter labextension install @jupyter-widgets/jupyterlab-manager
-
-
-def mapview(lookup_file='lookup.fgb'):
-    #=================================================================
-    # Interactive map serving as an overview for Global Point Data
-    #=================================================================
-    
-    # Define the path for the lookup file
-    lookup = os.path.join(os.getcwd(), lookup_file)
-
-    # Check if the lookup file exists
-    if not os.path.exists(lookup):
-        # Read the lookup table from the URL
-        lookup_table = gpd.read_file(lookup_table_url)
-        lookup_table['url'] = 'http://s3.eu-central-1.wasabisys.com/gedi-ard/level2/l2v002.gedi_20190418_20230316_go_epsg.4326_v20240614' + lookup_table['dir'] 
-        # Write the lookup table to a file
-        lookup_table.to_file(lookup, driver='FlatGeobuf')
+def _write_subset(lazyframe, filepath, format=None):
+    # plain parquet in source order, an uncompressed Arrow IPC file for memory
+    # mapping, or a Hilbert-sorted GeoParquet / FlatGeobuf export
+    if format is None:
+        lazyframe.sink_parquet(filepath)
+    elif format == 'arrow':
+        filepath = os.path.splitext(filepath)[0] + '.arrow'
+        # streamed to disk batch by batch, under the final name only once complete
+        tmp = f'{filepath}.{os.getpid()}.tmp'
+        lazyframe.sink_ipc(tmp, compression='uncompressed')
+        os.replace(tmp, filepath)
     else:
-        # Read the lookup table from the local file
-        lookup_table = gpd.read_file(lookup)
-
-    # Configure map options
-    basemaps = {
-        'Esri.WorldImagery': 'Esri.WorldImagery'
-    }
+        if format == 'flatgeobuf':
+            filepath = os.path.splitext(filepath)[0] + '.fgb'
+        export_points(lazyframe.collect_batches(), filepath, format)
+    return filepath
 
-    # Process the lookup table
-    lookup_table['n_points_mio'] = lookup_table['n_points'] / 1e06
-    lookup_table['year'] = lookup_table['year'].apply(lambda x: int(x))
-    ltm = {'N pts [mio]': lookup_table.iloc[1:2]}
-    ltm.update({year: group for year, group in lookup_table.groupby('year')})
 
-    # Create the base map
-    m = leafmap.Map(center=[0, 0], zoom=2)
-    for name, basemap in basemaps.items():
-        m.add_basemap(basemap)
-
-    # Add the layers to the map with customized colors
-    for year, data in ltm.items():
-        m.add_data(data, layer_name=f"Year {year}", column='n_points_mio', cmap='YlGn', legend_title='Number of Points (million)')
-
-    return m
+def mapview(lookup_file='lookup.fgb', mode='layers', cache_dir=None, lookup_url=None):
+    # the map stack is only imported when a map is drawn; mode='overview'
+    # draws cached per-tile totals and loads tile detail on zoom, see viz.py
+    from viz import mapview
+    return mapview(lookup_file, mode, cache_dir, lookup_url)
 
 
 
@@ -96,28 +67,132 @@ class gedil2:
     # Class of GEDI Level2 to query and download GEDI data on S3
     #=================================================================
 
-    def __init__(self, geometry=None, years=[2019,2020,2021,2022,2023]):
-        self.url_dataset = "https://s3.eu-central-1.wasabisys.com/gedi-ard/level2/l2v002.gedi_20190418_20230316_go_epsg.4326_v20240614"
+    def __init__(self, geometry=None, years=[2019,2020,2021,2022,2023], lookup_file='lookup.fgb', cache=None,
+                 url_dataset=None, hooks=None):
+        self.url_dataset = url_dataset or "https://s3.eu-central-1.wasabisys.com/gedi-ard/level2/l2v002.gedi_20190418_20230316_go_epsg.4326_v20240614"
         self.geometry = geometry
         self.years = years
+        self.lookup_file = lookup_file
+        # opt-in local partition cache (None, True, a directory or a PartitionCache)
+        self.cache = resolve_cache(cache)
+        self._downloader = None
+        # callables hook(name, start, end, attributes) receiving every timed span
+        self.hooks = hooks
+        # QueryStats of the latest tile_query, bbox_query or download_gedi
+        self.stats = None
+
+    def _new_stats(self, query):
+        self.stats = QueryStats(query, self.hooks)
+        return self.stats
+
+    def _tile_downloader(self):
+        # requests is only imported once something is downloaded
+        if self._downloader is None:
+            from download import TileDownloader
+            self._downloader = TileDownloader()
+        return self._downloader
     
-    def _build_bbox_query(self, url, cols, bbox):   
-        q =  pl.scan_parquet(url)
+    def _build_bbox_query(self, url, cols, geometry, quality=None):
+        # bbox and quality predicates are pushed into the parquet scan (row groups
+        # pruned on their statistics), then points are tested against the geometry itself
+        q = pl.scan_parquet(url)
+        if quality:
+            q = q.filter(quality.predicate())
+        q = filter_frame(q, geometry)
         if cols is not None:
             q = q.select(cols)
-        q = q.filter((pl.col('longitude') >= bbox[0]) & (pl.col('longitude') <= bbox[2]) &
-                     (pl.col('latitude') >= bbox[1]) & (pl.col('latitude') <= bbox[3]))
         return q
     
-    def _download_tile(self, url, filename, out_dir):
-        response = requests.get(url, stream=True)
-        filepath = os.path.join(out_dir, filename)
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        return filepath 
+    def _download_tile(self, url, filename, out_dir, stats, remote=None, manifest=None, record=None):
+        with stats.span('fetch', filename):
+            if manifest is not None and remote is None:
+                remote = self._tile_downloader()._retry(lambda: self._tile_downloader().head_info(url, stats))
+            filepath, transferred = self._tile_downloader().download(url, os.path.join(out_dir, filename), stats, remote)
+        # tiles whose local copy is current count as pruned
+        stats.add(**{'partitions_read' if transferred else 'partitions_pruned': 1})
+        if manifest is not None:
+            manifest.update(filename, url=url, version=dataset_version(self.url_dataset), **remote, **record)
+        return filepath
+
+    @staticmethod
+    def _tile_filename(dir_path):
+        return f"GEDI{os.path.basename(dir_path.replace('/','_'))}"
+
+    def _remote_info(self, url, stats):
+        # HEAD of a tile, None if it no longer exists remotely
+        import requests
+        try:
+            return self._tile_downloader()._retry(lambda: self._tile_downloader().head_info(url, stats))
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    def _sync_plan(self, jobs, out_dir, manifest, check, cores, stats):
+        # split the selected tiles into new/changed ones, unchanged ones and remotely deleted ones
+        if check not in ('head', 'lookup'):
+            raise ValueError(f"Unsupported check '{check}', use 'head' or 'lookup'")
+        version = dataset_version(self.url_dataset)
+        remotes = [None] * len(jobs)
+        if check == 'head':
+            from joblib import Parallel, delayed
+            with stats.span('listing'):
+                remotes = Parallel(n_jobs=cores, prefer='threads')(
+                    delayed(self._remote_info)(job['url'], stats) for job in jobs)
+
+        todo, deleted = [], []
+        for job, remote in zip(jobs, remotes):
+            entry = manifest.get(job['filename'])
+            path = os.path.join(out_dir, job['filename'])
+            local = entry is not None and os.path.exists(path) and os.path.getsize(path) == entry.get('size')
+            if check == 'head' and remote is None:
+                deleted.append(job['filename'])
+                continue
+            if check == 'lookup':
+                # no requests: trust the row count and location listed in lookup.fgb
+                changed = not local or entry['dir'] != job['record']['dir'] or entry['n_points'] != job['record']['n_points']
+            elif remote['etag'] is not None and entry is not None and entry.get('etag') is not None:
+                changed = not local or entry['etag'] != remote['etag']
+            else:
+                changed = not local or entry['size'] != remote['size'] or entry.get('last_modified') != remote['last_modified']
+            if changed:
+                todo.append(dict(job, remote=remote))
+            else:
+                stats.add(partitions_pruned=1)
+                if entry['version'] != version:
+                    # unchanged in the new dataset version, recorded as current without a transfer
+                    manifest.update(job['filename'], **dict(entry, url=job['url'], version=version, **(remote or {})))
+        return todo, deleted
+
+    def _prune(self, out_dir, manifest, deleted):
+        # remove local tiles that are gone remotely or no longer listed in lookup.fgb
+        listed = {self._tile_filename(dir_path) for dir_path in get_catalog(self.lookup_file).table['dir']}
+        names = set(deleted) | {name for name in manifest.names() if name not in listed}
+        for name in names:
+            for path in (name, f'.{name}.etag', f'.{name}.part', f'.{name}.part.etag'):
+                path = os.path.join(out_dir, path)
+                if os.path.exists(path):
+                    os.remove(path)
+            manifest.remove(name)
+        return sorted(names)
+
+    def _source(self, dir, stats):
+        # remote url of a tile, or its local copy when the partition cache is enabled
+        url = f"{self.url_dataset}{dir}"
+        if self.cache is None:
+            return url
+        with stats.span('fetch', dir):
+            return self.cache.get(self.url_dataset, dir, lambda path: self._tile_downloader().fetch(url, path, stats))
     
-    def bbox_query(self,columns='reduced'):
+    def bbox_query(self,columns='reduced',quality=None):
+        """
+        Lazy polars queries of the points inside the geometry, one per tile.
+
+        quality: shot filter pushed into the parquet scan, a preset ('good',
+        'strict', ...), a dict of column conditions in physical units or a
+        list of both, see quality.py.
+        """
+        quality = QualityFilter(quality)
         with open('reduced_columns.txt') as f:
             reduced_columns = [i.replace('\n','') for i in f.readlines()]
 
@@ -128,76 +203,133 @@ class gedil2:
         else:
             cols = columns
 
-        tls = self.tile_query()
-        bbox = tls.bbox
-        urls = [f"{self.url_dataset}{dir}" for dir in tls['dir']]
+        # the queries are lazy, self.stats only covers planning and cache fetches
+        stats = self._new_stats('bbox_query')
+        tls = self._tiles(stats)
+        urls = [self._source(dir, stats) for dir in tls['dir']]
         nms = [f"GEDI_tile_subset{urlparse(dir).path.replace('/', '_')}" for dir in tls['dir']]
 
-        queries = [self._build_bbox_query(url, cols, bbox) for url in urls]
+        queries = [self._build_bbox_query(url, cols, self.geometry, quality) for url in urls]
         queries_dict = dict(zip(nms, queries))
+        stats.finish()
         return queries_dict
-    
-    def tile_query(self):
-        lookup_table = gpd.read_file('lookup.fgb')  
-        # input as geopandas dataframe
 
-        tiles = lookup_table[lookup_table.intersects(self.geometry)]
-        tiles = tiles[tiles['year'].isin(self.years)]
+    def _tiles(self, stats):
+        # lookup table is loaded once per process and indexed with an STRtree
+        with stats.span('listing'):
+            tiles = get_catalog(self.lookup_file).query(self.geometry, self.years)
+        stats.add(partitions_planned=len(tiles))
 
         x_bb = self.geometry.bounds
         tiles.bbox = x_bb
         return tiles
+    
+    def tile_query(self):
+        stats = self._new_stats('tile_query')
+        tiles = self._tiles(stats)
+        stats.finish()
+        return tiles
 
     def show_gedi_columns(self):
         return pd.read_csv("gedi_columns.csv") 
 
     
-    def download_gedi(self, x, out_dir=None, cores=1, progress=True, require_confirmation=True):
-        
+    def download_gedi(self, x, out_dir=None, cores=1, progress=True, require_confirmation=True,
+                      chunk_size=8 * 1024 * 1024, retries=5, sync=False, check='head', prune=False, format=None):
+        """
+        Download the tiles of a tile_query() result, or write the subsets of a bbox_query().
+
+        sync=True keeps a manifest.json in `out_dir` and fetches only tiles that
+        are new or changed since the last sync: check='head' compares the remote
+        ETag/size/Last-Modified from one HEAD request per tile, check='lookup'
+        compares the row counts of lookup.fgb without any request. prune=True
+        also deletes local tiles that are gone remotely or from lookup.fgb.
+
+        format='geoparquet' or 'flatgeobuf' writes bbox subsets spatially
+        sorted with geometry metadata (see export.export_points) instead of
+        plain parquet in source order. format='arrow' streams them into
+        uncompressed Arrow IPC files and returns a dict of memory-mapped polars
+        DataFrames over them (see ipc.open_ipc), keyed like `x`, without
+        reading them into RAM.
+        """
         if out_dir is None:
             out_dir = os.path.join(os.getcwd(), "GEDI_download")
         if not os.path.exists(out_dir):
             os.makedirs(out_dir, exist_ok=True)
         t = time.time()
-        if isinstance(x, gpd.GeoDataFrame):
+        stats = self._new_stats('download_gedi')
+        result = None
+        from joblib import Parallel, delayed
+        # a GeoDataFrame can only come from an already imported geopandas
+        if 'geopandas' in sys.modules and isinstance(x, sys.modules['geopandas'].GeoDataFrame):
             if all(col in x.columns for col in ["lon", "lat", "year", "dir"]):
-                n = x['n_points'].sum()
+                from download import TileDownloader
+                self._downloader = TileDownloader(chunk_size=chunk_size, retries=retries, pool_size=max(cores, 1) * 2)
+                jobs = [{'url': self.url_dataset + dir_path, 'filename': self._tile_filename(dir_path), 'remote': None,
+                         'record': {'dir': dir_path, 'n_points': int(n_points)}}
+                        for dir_path, n_points in zip(x['dir'], x['n_points'])]
+                stats.add(partitions_planned=len(jobs))
+                manifest = None
+                if sync:
+                    manifest = Manifest(out_dir)
+                    jobs, deleted = self._sync_plan(jobs, out_dir, manifest, check, cores, stats)
+                    print(f"{len(jobs)} of {len(x)} tiles are new or changed")
+                    if prune:
+                        removed = self._prune(out_dir, manifest, deleted)
+                        print(f"Removed {len(removed)} tiles no longer in the dataset")
+                    manifest.save()
+                n = sum(job['record']['n_points'] for job in jobs)
                 answ = 'y'
                 if require_confirmation and n > 1e7:
-                    answ = input(f"You are about to download {len(x)} tiles with {n / 1e6:.1f} million points. Do you want to continue? (y/n): ")
+                    answ = input(f"You are about to download {len(jobs)} tiles with {n / 1e6:.1f} million points. Do you want to continue? (y/n): ")
                 if answ.lower() in ('', 'y'):
                     print("Downloading tiles...")
-                    urls = [self.url_dataset + dir_path for dir_path in x['dir']]
-                    filenames = [f"GEDI{os.path.basename(dir_path.replace('/','_'))}" for dir_path in x['dir']]
                     if cores == 1:
-                        for url, filename in tqdm(zip(urls, filenames), desc="Downloading tiles"):
-                            print(url,filename)
-                            self._download_tile(url, filename, out_dir)
+                        for job in tqdm(jobs, desc="Downloading tiles", total=len(jobs), disable=not progress):
+                            self._download_tile(job['url'], job['filename'], out_dir, stats, job['remote'], manifest, job['record'])
                     else:
-                        args = []
-                        for url, filename in zip(urls, filenames):
-                            args.append([url, filename])
-                        if progress:
-                            with tqdm_joblib(tqdm(desc="Downloading tiles", total=cores)) as progress_bar:  
-                                Parallel(n_jobs=cores)(delayed(self._download_tile)(i[0],i[1],out_dir) for i in args)
+                        # threads share the downloader's connection pool
+                        with tqdm_joblib(tqdm(desc="Downloading tiles", total=len(jobs), disable=not progress)) as progress_bar:
+                            Parallel(n_jobs=cores, prefer='threads')(
+                                delayed(self._download_tile)(job['url'], job['filename'], out_dir, stats,
+                                                             job['remote'], manifest, job['record'])
+                                for job in jobs)
+                    if manifest is not None:
+                        manifest.save()
                                                   
                 else:
                     print("Download aborted.")
                     out_dir = ""
         elif isinstance(x, dict):
             print("Downloading bbox subsets...")
+            stats.add(partitions_planned=len(x))
             def sink_parallel(lazyframe,filename):
-                lazyframe.sink_parquet(filename)
-                
+                start = time.time()
+                filepath = _write_subset(lazyframe, filename, format)
+                return filepath, start, time.time()
+
+            written = {}
             if cores > 1:
                 args = []
                 for filename,item in x.items():
                     args.append((item,filename))
-                if progress:
-                    with tqdm_joblib(tqdm(desc="Downloading subset", total=cores)) as progress_bar:        
-                        Parallel(n_jobs=cores)(delayed(sink_parallel)(i[0],f'{out_dir}/{i[1]}') for i in args)
+                with tqdm_joblib(tqdm(desc="Downloading subset", total=len(args), disable=not progress)) as progress_bar:
+                    spans = Parallel(n_jobs=cores)(delayed(sink_parallel)(i[0],f'{out_dir}/{i[1]}') for i in args)
+                # the subsets are read in worker processes, only their wall time is known here
+                for (_, filename), (filepath, start, end) in zip(args, spans):
+                    stats.record('fetch', start, end, filename)
+                    stats.add(partitions_read=1)
+                    written[filename] = filepath
             else:
-                for filename,item in tqdm(x.items(), desc="Downloading subset"):
-                    item.sink_parquet(f"{out_dir}/{filename}")
+                for filename,item in tqdm(x.items(), desc="Downloading subset", disable=not progress):
+                    with stats.span('fetch', filename):
+                        written[filename] = _write_subset(item, f"{out_dir}/{filename}", format)
+                    stats.add(partitions_read=1)
+            if format == 'arrow':
+                # memory-mapped views of the written files, nothing is read into RAM
+                from ipc import open_ipc
+                result = {filename: open_ipc(filepath, 'polars') for filename, filepath in written.items()}
+        stats.finish()
         elapsed_time = time.time() - t
-        print(f"Completed after {elapsed_time:.2f} sec.")
\ No newline at end of file
+        print(f"Completed after {elapsed_time:.2f} sec.")
+        return result
\ No newline at end of file
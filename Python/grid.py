@@ -0,0 +1,116 @@
+import re
+
+import polars as pl
+
+#=================================================================
+# Gridded aggregation of GEDI shots
+#=================================================================
+# Shots are binned into square cells aligned with the 1x1 degree tiles
+# (and optionally months or years) and reduced to mergeable partial
+# aggregates: count, mean, sum of squared deviations (M2), min and max per
+# cell. Partials of batches, partitions and workers are merged with one
+# more group-by using Chan's parallel update of (n, mean, M2), which stays
+# accurate for columns with a large offset such as delta_time, so memory
+# grows with the number of cells, not the number of shots.
+
+MOMENTS = ('mean', 'std', 'min', 'max', 'sum')
+FREQS = (None, 'month', 'year')
+
+_PERCENTILE = re.compile(r'p(\d+(\.\d+)?)')
+
+
+def parse_stats(stats):
+    """Split statistic names into moments ('mean', 'std', ...) and percentiles ('p50', 'p95', ...)."""
+    moments, percentiles = [], []
+    for stat in stats:
+        if stat == 'count':
+            continue
+        if stat in MOMENTS:
+            moments.append(stat)
+        elif _PERCENTILE.fullmatch(stat) and float(stat[1:]) <= 100:
+            percentiles.append(stat)
+        else:
+            raise ValueError(f"Unsupported statistic '{stat}', use 'count', {', '.join(map(repr, MOMENTS))} or 'p0'..'p100'")
+    return moments, percentiles
+
+
+def cells_per_degree(cell_size):
+    n = round(1 / cell_size)
+    if n < 1 or abs(n * cell_size - 1) > 1e-9:
+        raise ValueError('cell_size must divide one degree, e.g. 0.01, 0.05, 0.25 or 1')
+    return n
+
+
+def group_keys(freq):
+    if freq not in FREQS:
+        raise ValueError(f"Unsupported freq '{freq}', use None, 'month' or 'year'")
+    return ['ix', 'iy'] + (['time'] if freq else [])
+
+
+def cell_exprs(n, freq=None):
+    # cell index counted inside the point's 1x1 degree tile, so no cell straddles two tiles
+    def index(coord):
+        tile = pl.col(coord).floor()
+        return (tile * n + ((pl.col(coord) - tile) * n).floor().clip(upper_bound=n - 1)).cast(pl.Int32)
+    exprs = [index('longitude').alias('ix'), index('latitude').alias('iy')]
+    if freq is not None:
+        t = pl.from_epoch('delta_time', time_unit='s')
+        exprs.append((t.dt.truncate('1mo').dt.date() if freq == 'month' else t.dt.year()).alias('time'))
+    return exprs
+
+
+def partial_aggs(columns):
+    aggs = [pl.len().cast(pl.Int64).alias('count')]
+    for col in columns:
+        v = pl.col(col).cast(pl.Float64)
+        aggs += [v.count().cast(pl.Int64).alias(f'{col}__n'), v.mean().alias(f'{col}__mean'),
+                 ((v - v.mean()) ** 2).sum().alias(f'{col}__m2'), v.min().alias(f'{col}__min'), v.max().alias(f'{col}__max')]
+    return aggs
+
+
+def percentile_aggs(columns, percentiles):
+    # only exact on complete groups, the caller makes sure no group is split
+    return [pl.col(col).cast(pl.Float64).quantile(float(p[1:]) / 100, interpolation='linear').alias(f'{col}_{p}')
+            for col in columns for p in percentiles]
+
+
+def empty_partials(keys, columns, percentiles=(), freq=None):
+    # partials of no shots, so a query without points still has the output columns
+    schema = {'ix': pl.Int32, 'iy': pl.Int32}
+    if freq is not None:
+        schema['time'] = pl.Date if freq == 'month' else pl.Int32
+    schema.update({col: pl.Float64 for col in columns})
+    return pl.DataFrame(schema=schema).group_by(keys).agg(partial_aggs(columns) + percentile_aggs(columns, percentiles))
+
+
+def merge_partials(frames, keys, columns, percentiles=()):
+    """Combine partial aggregates of the same cells from several batches, partitions or workers."""
+    frames = [f for f in frames if f is not None]
+    if not frames:
+        return None
+    aggs = [pl.col('count').sum()]
+    for col in columns:
+        count, mean = pl.col(f'{col}__n'), pl.col(f'{col}__mean')
+        merged = ((count * mean).sum() / count.sum()).fill_nan(None)
+        # M2 of the union: the parts' M2 plus the spread of their means around the merged mean
+        aggs += [count.sum(), merged.alias(f'{col}__mean'),
+                 (pl.col(f'{col}__m2').sum() + (count * (mean - merged) ** 2).sum()).alias(f'{col}__m2'),
+                 pl.col(f'{col}__min').min(), pl.col(f'{col}__max').max()]
+    # percentiles come from the single partial holding the whole group
+    aggs += [pl.col(f'{col}_{p}').drop_nulls().first() for col in columns for p in percentiles]
+    return pl.concat(frames, how='vertical_relaxed').group_by(keys).agg(aggs)
+
+
+def finalize(partials, keys, columns, moments, percentiles, n):
+    """Raster-like table: cell centre x/y, time bin, count and the requested statistics."""
+    out = [((pl.col('ix') + 0.5) / n).alias('x'), ((pl.col('iy') + 0.5) / n).alias('y')]
+    out += [pl.col(k) for k in keys if k not in ('ix', 'iy')] + [pl.col('count')]
+    for col in columns:
+        count, mean = pl.col(f'{col}__n'), pl.col(f'{col}__mean')
+        exprs = {'mean': mean,
+                 'std': pl.when(count > 1).then((pl.col(f'{col}__m2') / (count - 1)).sqrt()),
+                 'min': pl.col(f'{col}__min'), 'max': pl.col(f'{col}__max'),
+                 'sum': (count * mean).fill_null(0.0)}
+        out += [exprs[m].alias(f'{col}_{m}') for m in moments]
+        out += [pl.col(f'{col}_{p}') for p in percentiles]
+    return partials.sort(keys).select(out)
@@ -0,0 +1,59 @@
+import os
+
+import pyarrow as pa
+
+#=================================================================
+# Out-of-core results in memory-mapped Arrow IPC files
+#=================================================================
+# Query results are written batch by batch into an uncompressed Arrow IPC
+# (Feather v2) file and opened again through a memory map. Uncompressed
+# buffers are used in place, so a table larger than RAM can be sliced and
+# reopened later from the page cache without reading or copying it.
+
+
+def write_ipc(tables, path, schema=None):
+    """
+    Write an iterable of Arrow tables into one IPC file, returns the rows written.
+
+    The file appears under `path` only once it is complete. Without any rows
+    no file is written, unless `schema` is given for an empty one.
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    writer, rows = None, 0
+    try:
+        for table in tables:
+            if table is None or table.num_rows == 0:
+                continue
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(tmp, schema)
+            writer.write_table(table.cast(schema))
+            rows += table.num_rows
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if writer is None:
+        if schema is None:
+            return 0
+        writer = pa.ipc.new_file(tmp, schema)
+    writer.close()
+    os.replace(tmp, path)
+    return rows
+
+
+def open_ipc(path, output='arrow'):
+    """
+    Memory-mapped, zero-copy view of an Arrow IPC file.
+
+    output: 'arrow' (pyarrow Table) or 'polars' (DataFrame over the same buffers).
+    """
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    if output == 'polars':
+        import polars as pl
+        return pl.from_arrow(table, rechunk=False)
+    if output != 'arrow':
+        raise ValueError(f"Unsupported output '{output}', use 'arrow' or 'polars'")
+    return table
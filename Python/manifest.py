@@ -0,0 +1,59 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+
+class Manifest:
+    #=================================================================
+    # Local record of the tiles mirrored into a download directory
+    #=================================================================
+    # One JSON file per directory, keyed by the local file name, holding
+    # what the tile was synced from: dataset url and version, remote size,
+    # ETag and Last-Modified, and the row count listed in lookup.fgb.
+
+    FILENAME = 'manifest.json'
+
+    def __init__(self, out_dir, save_every=5.0):
+        self.path = os.path.join(out_dir, self.FILENAME)
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._saved = time.time()
+        self.tiles = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.tiles = json.load(f)['tiles']
+
+    def get(self, name):
+        return self.tiles.get(name)
+
+    def names(self):
+        return list(self.tiles)
+
+    def update(self, name, **entry):
+        # saved now and then while a sync runs, so an interrupted run keeps most of its record
+        with self._lock:
+            self.tiles[name] = dict(entry, synced=time.time())
+            if time.time() - self._saved > self.save_every:
+                self._save()
+
+    def remove(self, name):
+        with self._lock:
+            self.tiles.pop(name, None)
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp = f'{self.path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'updated': time.time(), 'tiles': self.tiles}, f, indent=1)
+        os.replace(tmp, self.path)
+        self._saved = time.time()
+
+
+def dataset_version(url_dataset):
+    # last path element of the dataset url, e.g. l2v002.gedi_20190418_20230316_go_epsg.4326_v20240614
+    return url_dataset.rstrip('/').rsplit('/', 1)[-1]
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from cache import default_cache_dir
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('tile', pa.string()), ('year', pa.int32()), ('month', pa.int32())]),
+    flavor='hive')
+
+
+class HiveDataset:
+    #=================================================================
+    # One hive-partitioned dataset over the whole parquet root
+    #=================================================================
+    # The file listing is fetched once and persisted locally with a TTL,
+    # and its fragments are indexed by tile/year/month, so selecting a
+    # partition is a dict lookup instead of an S3 LIST per partition.
+
+    def __init__(self, fs, root, listing_dir=None, ttl=24 * 3600):
+        if listing_dir is None:
+            listing_dir = os.path.join(default_cache_dir(), 'listings')
+        self.fs = fs
+        self.root = root.rstrip('/')
+        self.listing_dir = listing_dir
+        self.ttl = ttl
+        self._dataset = None
+        self._schema = None
+        self._index = None
+
+    def __getstate__(self):
+        # workers rebuild the dataset from the persisted listing
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        state['_index'] = None
+        return state
+
+    @property
+    def listing_file(self):
+        key = hashlib.sha256(f'{type(self.fs).__name__}|{self.root}'.encode()).hexdigest()[:16]
+        return os.path.join(self.listing_dir, f'{key}.json')
+
+    def _list(self):
+        files = self.fs.find(self.root, detail=True)
+        return sorted(path for path, info in files.items()
+                      if path.endswith('.parquet') and info.get('type', 'file') == 'file')
+
+    def listing(self, refresh=False):
+        """Paths of all parquet files below the root, from the local listing if it is fresh."""
+        path = self.listing_file
+        if not refresh and os.path.exists(path) and time.time() - os.path.getmtime(path) < self.ttl:
+            with open(path) as f:
+                return json.load(f)['files']
+        files = self._list()
+        os.makedirs(self.listing_dir, exist_ok=True)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'root': self.root, 'created': time.time(), 'files': files}, f)
+        os.replace(tmp, path)
+        return files
+
+    def dataset(self, refresh=False):
+        if self._dataset is None or refresh:
+            self._dataset = ds.dataset(self.listing(refresh), format='parquet', filesystem=self.fs,
+                                       partitioning=PARTITIONING, partition_base_dir=self.root)
+            # file columns only, the partition keys stay in the paths
+            partition_keys = set(PARTITIONING.schema.names)
+            self._schema = pa.schema([f for f in self._dataset.schema if f.name not in partition_keys])
+            self._index = self._build_index(self._dataset)
+        return self._dataset
+
+    @property
+    def schema(self):
+        # columns of the parquet files, without the partition keys
+        if self._schema is None:
+            self.dataset()
+        return self._schema
+
+    @staticmethod
+    def _build_index(dataset):
+        # fragments per (tile, year, month), also filed under the keys with year and/or month left out
+        index = {}
+        for fragment in dataset.get_fragments():
+            keys = ds.get_partition_keys(fragment.partition_expression)
+            tile, year, month = keys.get('tile'), keys.get('year'), keys.get('month')
+            for key in {(tile, year, month), (tile, year, None), (tile, None, month), (tile, None, None)}:
+                index.setdefault(key, []).append(fragment)
+        return index
+
+    @staticmethod
+    def partition_filter(tile, year=None, month=None):
+        expr = ds.field('tile') == tile
+        if year is not None:
+            expr &= ds.field('year') == int(year)
+        if month is not None:
+            expr &= ds.field('month') == int(month)
+        return expr
+
+    def select(self, tile, year=None, month=None):
+        """Dataset of one tile/year/month partition, None if it holds no files."""
+        full = self.dataset()
+        fragments = self._index.get((tile, None if year is None else int(year), None if month is None else int(month)))
+        if not fragments:
+            return None
+        return ds.FileSystemDataset(fragments, self._schema, full.format, full.filesystem)
@@ -0,0 +1,127 @@
+import math
+
+import polars as pl
+import pyarrow.dataset as ds
+
+from columns import SCALE_FACTORS
+
+#=================================================================
+# Quality filters pushed down to the parquet scan
+#=================================================================
+# A filter is a preset name, a dict {column: condition} or a list of both,
+# all ANDed. Conditions are given in physical units and compared with the
+# stored integers, so they run inside the parquet reader (pyarrow or
+# polars) and row groups whose statistics cannot match are never fetched.
+#
+#   True / 1.0                 equal to the value
+#   [1, 2]                     one of the values
+#   ('>=', 0.95)               comparison: '==', '!=', '<', '<=', '>', '>='
+#   ('between', 0.9, 0.98)     lower <= value <= upper
+
+PRESETS = {
+    # L2B quality flag only
+    'l2b_quality': {'l2b_quality_flag': True},
+    # qualified shots on the DEM surface (sensitivity is pre-filtered >= 0.95 in the dataset)
+    'good': {'l2b_quality_flag': True, 'surface_flag': True},
+    # good shots with high sensitivity under leaf-on conditions
+    'strict': {'l2b_quality_flag': True, 'surface_flag': True, 'leaf_off_flag': False,
+               'sensitivity': ('>=', 0.98)},
+    # good shots acquired at night, less solar background noise
+    'night': {'l2b_quality_flag': True, 'surface_flag': True, 'night_flag': True},
+}
+
+OPERATORS = ('==', '!=', '<', '<=', '>', '>=')
+
+
+def _stored(column, value, scale_factors):
+    # physical value in the units of the stored integers
+    if isinstance(value, bool) or column not in scale_factors:
+        return value
+    value = value / scale_factors[column]
+    return int(round(value)) if math.isclose(value, round(value), abs_tol=1e-6) else value
+
+
+def _conditions(column, condition, scale_factors):
+    # (column, operator, stored value) triples of one dict entry
+    if isinstance(condition, (list, set)):
+        return [(column, 'in', [_stored(column, v, scale_factors) for v in condition])]
+    if isinstance(condition, tuple):
+        if condition and condition[0] == 'between' and len(condition) == 3:
+            return [(column, '>=', _stored(column, condition[1], scale_factors)),
+                    (column, '<=', _stored(column, condition[2], scale_factors))]
+        if len(condition) == 2 and condition[0] in OPERATORS:
+            return [(column, condition[0], _stored(column, condition[1], scale_factors))]
+        raise ValueError(f"Unsupported condition {condition} on '{column}', "
+                         f"use (op, value) with op in {OPERATORS} or ('between', lower, upper)")
+    return [(column, '==', _stored(column, condition, scale_factors))]
+
+
+def _compare(field, op, value):
+    # the same comparison on a pyarrow field or a polars column
+    if op == 'in':
+        return field.isin(value) if isinstance(field, ds.Expression) else field.is_in(value)
+    return {'==': field.__eq__, '!=': field.__ne__, '<': field.__lt__, '<=': field.__le__,
+            '>': field.__gt__, '>=': field.__ge__}[op](value)
+
+
+def _may_match(statistics, op, value):
+    # whether a row group with these min/max statistics can hold a matching row
+    if statistics is None or not statistics.has_min_max:
+        return True
+    lo, hi = statistics.min, statistics.max
+    if op == 'in':
+        return any(lo <= v <= hi for v in value)
+    return {'==': lo <= value <= hi, '!=': not (lo == hi == value), '<': lo < value, '<=': lo <= value,
+            '>': hi > value, '>=': hi >= value}[op]
+
+
+class QualityFilter:
+    def __init__(self, filters=None, scale_factors=SCALE_FACTORS):
+        self.filters = filters
+        self.conditions = []
+        for spec in ([] if filters is None else filters if isinstance(filters, list) else [filters]):
+            if isinstance(spec, str):
+                if spec not in PRESETS:
+                    raise ValueError(f"Unknown quality preset '{spec}', use one of {', '.join(PRESETS)}")
+                spec = PRESETS[spec]
+            if not isinstance(spec, dict):
+                raise ValueError(f'Unsupported filter {spec!r}, use a preset name or a dict of column conditions')
+            for column, condition in spec.items():
+                self.conditions += _conditions(column, condition, scale_factors)
+
+    def __repr__(self):
+        return f'QualityFilter({self.filters!r})'
+
+    def __bool__(self):
+        return bool(self.conditions)
+
+    @property
+    def columns(self):
+        return list(dict.fromkeys(column for column, _, _ in self.conditions))
+
+    def expression(self):
+        """pyarrow predicate on the stored values, None without conditions."""
+        expression = None
+        for column, op, value in self.conditions:
+            e = _compare(ds.field(column), op, value)
+            expression = e if expression is None else expression & e
+        return expression
+
+    def predicate(self):
+        # polars counterpart of expression()
+        predicate = None
+        for column, op, value in self.conditions:
+            p = _compare(pl.col(column), op, value)
+            predicate = p if predicate is None else predicate & p
+        return predicate
+
+    def prune_row_groups(self, metadata, row_groups=None):
+        """Row groups whose statistics may hold rows passing every condition."""
+        if row_groups is None:
+            row_groups = range(metadata.num_row_groups)
+        if not self.conditions:
+            return list(row_groups)
+        names = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+        checks = [(names.index(column), op, value) for column, op, value in self.conditions if column in names]
+        return [i for i in row_groups
+                if all(_may_match(metadata.row_group(i).column(j).statistics, op, value) for j, op, value in checks)]
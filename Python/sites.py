@@ -0,0 +1,128 @@
+import numpy as np
+import pyarrow as pa
+import polars as pl
+import shapely
+from joblib import Parallel, delayed
+
+from func import gedil2, _tile_name, _to_output, _scale_frame
+from spatial import prune_dataset, bbox_predicate
+
+#=================================================================
+# Batch extraction of GEDI shots around many sites
+#=================================================================
+# Sites are bucketed by the 1x1 degree tiles their search windows touch,
+# every tile (and its time partitions) is read once, and the shots are
+# joined to all sites of the tile in one vectorized STRtree query.
+
+EARTH_RADIUS = 6371008.8
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    # great-circle distance in metres
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _search_windows(lon, lat, radius):
+    # lon/lat boxes that contain every point within `radius` metres
+    dlat = np.degrees(radius / EARTH_RADIUS)
+    coslat = np.cos(np.radians(np.minimum(np.abs(lat) + dlat, 89.9)))
+    dlon = dlat / coslat
+    return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+
+def _bucket_sites(xmin, ymin, xmax, ymax):
+    # site indices per tile, a window crossing a tile edge goes to every tile it touches
+    tx0, ty0 = np.floor(xmin).astype(int), np.floor(ymin).astype(int)
+    tx1, ty1 = np.floor(xmax).astype(int), np.floor(ymax).astype(int)
+    nx, ny = tx1 - tx0 + 1, ty1 - ty0 + 1
+    # one row per (site, tile) pair, the k-th pair of a site is tile (k % nx, k // nx) of its window
+    counts = nx * ny
+    site = np.repeat(np.arange(len(xmin)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pairs = pl.DataFrame({'lon': tx0[site] + k % nx[site], 'lat': ty0[site] + k // nx[site], 'site': site})
+    buckets = pairs.group_by('lon', 'lat', maintain_order=True).agg('site')
+    return {_tile_name(lon, lat): np.asarray(sites) for lon, lat, sites in buckets.iter_rows()}
+
+
+def _nearest_k(df, k):
+    return df.sort('site_id', 'distance_m').group_by('site_id', maintain_order=True).head(k)
+
+
+def _extract_tile(reader, tile, ids, lon, lat, radius, k, columns):
+    metas = reader._scan_partitions(reader._partition_args([tile]))
+    if not metas:
+        return None
+    xmin, ymin, xmax, ymax = _search_windows(lon, lat, radius)
+    bbox = (xmin.min(), ymin.min(), xmax.max(), ymax.max())
+
+    frames = []
+    for meta in metas:
+        with reader._data_source(meta) as source:
+            df = pl.scan_pyarrow_dataset(prune_dataset(source, meta['metadata'], bbox))
+            df = df.filter(bbox_predicate(bbox))
+            if reader.window.predicate() is not None:
+                df = df.filter(reader.window.predicate())
+            if reader.quality:
+                df = df.filter(reader.quality.predicate())
+            if columns != '*':
+                df = df.select(list(dict.fromkeys([*columns, 'longitude', 'latitude'])))
+            frames.append(_scale_frame(df.collect()))
+    points = pl.concat(frames, how='vertical_relaxed')
+    if points.height == 0:
+        return None
+
+    plon, plat = points['longitude'].to_numpy(), points['latitude'].to_numpy()
+    tree = shapely.STRtree(shapely.box(xmin, ymin, xmax, ymax))
+    pt_idx, site_idx = tree.query(shapely.points(plon, plat), predicate='intersects')
+    distance = _haversine(lon[site_idx], lat[site_idx], plon[pt_idx], plat[pt_idx])
+    keep = distance <= radius
+
+    out = points[pt_idx[keep]].with_columns(
+        pl.Series('site_id', ids[site_idx[keep]]),
+        pl.Series('distance_m', distance[keep]),
+    )
+    if k is not None:
+        out = _nearest_k(out, k)
+    return out.to_arrow()
+
+
+def extract_sites(sites, radius=100, k=None, columns="*", site_id=None,
+                  start_dt='2019-04-18', end_dt='2023-03-16', n_jobs=-5, output='pandas', **kwargs):
+    """
+    GEDI shots within `radius` metres of each site, tagged with the site ID.
+
+    sites: GeoDataFrame of points (other geometries use their centroid).
+    k: keep only the k nearest shots of each site within the radius.
+    site_id: column holding the site IDs, defaults to the index.
+    Remaining keyword arguments are passed to func.gedil2 (e.g. cache).
+
+    Each tile is read once no matter how many sites it holds, so the I/O
+    scales with the number of distinct tiles. Tiles run in parallel.
+    """
+    if radius > 50000:
+        raise ValueError("radius must be at most 50 km")
+    if sites.crs is not None:
+        sites = sites.to_crs(4326)
+    centroids = shapely.centroid(sites.geometry.values)
+    lon, lat = shapely.get_x(centroids), shapely.get_y(centroids)
+    ids = (sites[site_id] if site_id is not None else sites.index).to_numpy()
+
+    reader = gedil2(None, start_dt=start_dt, end_dt=end_dt, n_jobs=1, **kwargs)
+    # persist the partition listing once so the workers do not list the bucket
+    reader.partitions.listing()
+    buckets = _bucket_sites(*_search_windows(lon, lat, radius))
+    print(f'extracting {len(sites)} sites from {len(buckets)} tiles')
+
+    tables = Parallel(n_jobs=n_jobs)(
+        delayed(_extract_tile)(reader, tile, ids[idx], lon[idx], lat[idx], radius, k, columns)
+        for tile, idx in buckets.items())
+    tables = [t for t in tables if t is not None]
+    if not tables:
+        return None
+    table = pa.concat_tables(tables, promote_options='permissive')
+    if k is not None:
+        # sites on tile edges collect candidates from several tiles
+        table = _nearest_k(pl.from_arrow(table), k).to_arrow()
+    return _to_output(table, output)
@@ -0,0 +1,84 @@
+import shapely
+import polars as pl
+import pyarrow.dataset as ds
+
+#=================================================================
+# Spatial filter stage for AOI queries
+#=================================================================
+# 1. prune row groups whose longitude/latitude statistics miss the bbox
+# 2. push the bbox predicate down to the parquet reader
+# 3. refine each decoded batch with a vectorized point-in-polygon test
+
+
+def is_areal(geometry):
+    # points and lines select whole tiles, only polygons can be refined
+    return geometry is not None and geometry.area > 0
+
+
+def _overlaps(statistics, lo, hi):
+    if statistics is None or not statistics.has_min_max:
+        return True
+    return statistics.max >= lo and statistics.min <= hi
+
+
+def prune_row_groups(metadata, bbox):
+    """Indices of the row groups in a parquet footer that may hold points inside `bbox`."""
+    names = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+    ilon, ilat = names.index('longitude'), names.index('latitude')
+    keep = []
+    for i in range(metadata.num_row_groups):
+        rg = metadata.row_group(i)
+        if (_overlaps(rg.column(ilon).statistics, bbox[0], bbox[2]) and
+                _overlaps(rg.column(ilat).statistics, bbox[1], bbox[3])):
+            keep.append(i)
+    return keep
+
+
+def dataset_subset(pyarrow_dataset, metadata, row_groups):
+    """Restrict a parquet dataset to the given row groups of each of its files."""
+    fragments = []
+    for fragment, md, keep in zip(pyarrow_dataset.get_fragments(), metadata, row_groups):
+        if len(keep) == md.num_row_groups:
+            fragments.append(fragment)
+        elif keep:
+            fragments.append(fragment.subset(row_group_ids=keep))
+    return ds.FileSystemDataset(fragments, pyarrow_dataset.schema, pyarrow_dataset.format,
+                                pyarrow_dataset.filesystem)
+
+
+def prune_dataset(pyarrow_dataset, metadata, bbox):
+    """Restrict a parquet dataset to the row groups that overlap `bbox`."""
+    return dataset_subset(pyarrow_dataset, metadata, [prune_row_groups(md, bbox) for md in metadata])
+
+
+def bbox_expression(bbox):
+    # pyarrow predicate, evaluated by the parquet reader
+    return ((ds.field('longitude') >= bbox[0]) & (ds.field('longitude') <= bbox[2]) &
+            (ds.field('latitude') >= bbox[1]) & (ds.field('latitude') <= bbox[3]))
+
+
+def bbox_predicate(bbox):
+    # polars predicate, pushed into scan_parquet / scan_pyarrow_dataset
+    return ((pl.col('longitude') >= bbox[0]) & (pl.col('longitude') <= bbox[2]) &
+            (pl.col('latitude') >= bbox[1]) & (pl.col('latitude') <= bbox[3]))
+
+
+def points_in_geometry(geometry, lon, lat):
+    """Boolean mask of the points (lon, lat) inside or on the boundary of `geometry`."""
+    shapely.prepare(geometry)
+    return shapely.intersects_xy(geometry, lon, lat)
+
+
+def geometry_predicate(geometry):
+    # polars predicate running the point-in-polygon test on each batch
+    def mask(series):
+        return pl.Series(points_in_geometry(geometry, series[0].to_numpy(), series[1].to_numpy()))
+    return pl.map_batches(['longitude', 'latitude'], mask, return_dtype=pl.Boolean)
+
+
+def filter_frame(df, geometry):
+    """Apply the bbox and exact geometry predicates to a polars (lazy) frame."""
+    df = df.filter(bbox_predicate(geometry.bounds))
+    if is_areal(geometry):
+        df = df.filter(geometry_predicate(geometry))
+    return df
@@ -0,0 +1,141 @@
+import time
+import threading
+import contextlib
+
+import pandas as pd
+
+# per-partition phases, in the order a partition goes through them
+PHASES = ('listing', 'fetch', 'decode', 'assemble')
+
+COUNTERS = ('partitions_planned', 'partitions_pruned', 'partitions_read',
+            'requests', 'bytes_transferred', 'bytes_decoded', 'rows')
+
+
+def partition_label(arg):
+    # '099E_20N' or '099E_20N/2020-03' for the partition arguments of func.gedil2
+    return arg if isinstance(arg, str) else '/'.join(str(a) for a in arg)
+
+
+class QueryStats:
+    #=================================================================
+    # I/O and timing record of one query
+    #=================================================================
+    # Readers add counters and time phases per partition. Every finished
+    # span is also passed to the hooks as hook(name, start, end, attributes)
+    # with epoch seconds, which maps one to one onto tracing spans, see
+    # opentelemetry_hook().
+
+    def __init__(self, query=None, hooks=None):
+        self.query = query
+        self.hooks = list(hooks or [])
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        self.phases = {}
+        self.timings = {}
+        self.spans = []
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # worker processes record into a copy without hooks, merged back afterwards
+        state = self.__dict__.copy()
+        state['hooks'] = []
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+    def record(self, phase, start, end, partition=None, **attributes):
+        """Add a timed span; without a partition it counts for the whole query."""
+        with self._lock:
+            target = self.phases if partition is None else self.timings.setdefault(partition, {})
+            target[phase] = target.get(phase, 0.0) + end - start
+            self.spans.append((phase, start, end, partition, attributes))
+        self._emit(phase, start, end, partition, attributes)
+
+    def _emit(self, phase, start, end, partition, attributes):
+        attributes = dict(attributes, query=self.query)
+        if partition is not None:
+            attributes['partition'] = partition
+        for hook in self.hooks:
+            hook(phase, start, end, attributes)
+
+    @contextlib.contextmanager
+    def span(self, phase, partition=None, **attributes):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, start, time.time(), partition, **attributes)
+
+    def merge(self, other):
+        # fold in the record of a worker
+        self.add(**{name: getattr(other, name) for name in COUNTERS})
+        for phase, start, end, partition, attributes in other.spans:
+            self.record(phase, start, end, partition, **attributes)
+
+    def finish(self):
+        self.finished = time.time()
+        self._emit('query', self.started, self.finished, None,
+                   {name: getattr(self, name) for name in COUNTERS})
+        return self
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def phase_totals(self):
+        # summed over partitions, so phases running concurrently can add up to more than elapsed
+        totals = {phase: self.phases.get(phase, 0.0) for phase in PHASES}
+        for timings in self.timings.values():
+            for phase, seconds in timings.items():
+                totals[phase] = totals.get(phase, 0.0) + seconds
+        return totals
+
+    @property
+    def bound(self):
+        """'listing', 'network' or 'cpu', whichever phase took the most time."""
+        totals = self.phase_totals()
+        kinds = {'listing': totals['listing'], 'network': totals['fetch'],
+                 'cpu': totals['decode'] + totals['assemble']}
+        return max(kinds, key=kinds.get) if any(kinds.values()) else None
+
+    def summary(self):
+        return {'query': self.query, 'elapsed': self.elapsed,
+                **{name: getattr(self, name) for name in COUNTERS},
+                **{f'{phase} seconds': seconds for phase, seconds in self.phase_totals().items()},
+                'bound': self.bound}
+
+    def to_frame(self):
+        """Per-partition latency of each phase in seconds."""
+        frame = pd.DataFrame.from_dict(self.timings, orient='index')
+        return frame.reindex(columns=[p for p in PHASES if p in frame.columns] +
+                             [p for p in frame.columns if p not in PHASES])
+
+    def __repr__(self):
+        return (f'QueryStats({self.query}: {self.partitions_read}/{self.partitions_planned} partitions read, '
+                f'{self.partitions_pruned} pruned, {self.requests} requests, '
+                f'{self.bytes_transferred / 1e6:.1f} MB transferred, {self.bytes_decoded / 1e6:.1f} MB decoded, '
+                f'{self.rows} rows in {self.elapsed:.2f} s' + (f', {self.bound}-bound)' if self.bound else ')'))
+
+
+def opentelemetry_hook(tracer, prefix='gedi.'):
+    """
+    Hook exporting the spans of a query through an OpenTelemetry tracer:
+
+        from opentelemetry import trace
+        gedil2(geom, hooks=[opentelemetry_hook(trace.get_tracer('gedi'))])
+    """
+    def hook(name, start, end, attributes):
+        span = tracer.start_span(prefix + name, start_time=int(start * 1e9),
+                                 attributes={k: v for k, v in attributes.items() if v is not None})
+        span.end(end_time=int(end * 1e9))
+    return hook
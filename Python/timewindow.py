@@ -0,0 +1,101 @@
+import pandas as pd
+import polars as pl
+import pyarrow.dataset as ds
+
+#=================================================================
+# Time window planning for the year/month partitions
+#=================================================================
+# A window is read from the fewest partitions that cover it (whole years
+# where every month is wanted, single months otherwise), and the exact
+# delta_time range is pushed into the parquet scan, where row groups are
+# pruned on their delta_time statistics. Seasonal windows pick the same
+# months in every year.
+
+# time span of the published dataset
+DATA_START = pd.Timestamp('2019-04-18')
+DATA_END = pd.Timestamp('2023-03-16')
+
+
+def _end_bound(end_dt):
+    # exclusive upper bound; a plain date includes the whole day
+    end = pd.Timestamp(end_dt)
+    return end + pd.Timedelta(days=1) if end == end.normalize() else end
+
+
+class TimeWindow:
+    def __init__(self, start_dt=DATA_START, end_dt=DATA_END, months=None):
+        self.start = pd.Timestamp(start_dt)
+        self.end = _end_bound(end_dt)
+        if self.end <= self.start:
+            raise ValueError(f'end_dt {end_dt} is before start_dt {start_dt}')
+        self.months = None if months is None else sorted({int(m) for m in months})
+        if self.months is not None and not set(self.months) <= set(range(1, 13)):
+            raise ValueError('months must be in 1..12')
+
+    def __repr__(self):
+        months = '' if self.months is None else f', months={self.months}'
+        return f'TimeWindow({self.start} - {self.end}{months})'
+
+    @property
+    def full(self):
+        """Whether the window holds the whole dataset, so no time partition or filter is needed."""
+        return self.months is None and self.start <= DATA_START and self.end > DATA_END
+
+    @property
+    def bounds(self):
+        # delta_time range in seconds since 1970-01-01, end exclusive
+        return int(self.start.timestamp()), int(self.end.timestamp())
+
+    def _aligned(self):
+        # start and end on month boundaries: the partitions alone select the window
+        return self.start == self.start.to_period('M').start_time and self.end == self.end.to_period('M').start_time
+
+    def blocks(self):
+        """
+        Time partitions covering the window as 'YYYY' or 'YYYY-MM' strings,
+        None if the whole dataset is wanted.
+        """
+        if self.full:
+            return None
+        periods = pd.period_range(self.start, self.end - pd.Timedelta(seconds=1), freq='M')
+        if self.months is not None:
+            periods = periods[periods.month.isin(self.months)]
+        blocks = []
+        for year, group in pd.Series(periods.month, index=periods.year).groupby(level=0):
+            if len(group) == 12:
+                blocks.append(str(year))
+            else:
+                blocks += [f'{year}-{str(month).zfill(2)}' for month in group]
+        return blocks
+
+    def expression(self):
+        """pyarrow predicate on delta_time, None when the partitions select the window exactly."""
+        if self.full or self._aligned():
+            return None
+        t0, t1 = self.bounds
+        return (ds.field('delta_time') >= t0) & (ds.field('delta_time') < t1)
+
+    def predicate(self):
+        # polars counterpart of expression()
+        if self.full or self._aligned():
+            return None
+        t0, t1 = self.bounds
+        return (pl.col('delta_time') >= t0) & (pl.col('delta_time') < t1)
+
+    def prune_row_groups(self, metadata, row_groups=None):
+        """Row groups whose delta_time statistics overlap the window."""
+        if row_groups is None:
+            row_groups = range(metadata.num_row_groups)
+        if self.expression() is None:
+            return list(row_groups)
+        names = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+        if 'delta_time' not in names:
+            return list(row_groups)
+        j = names.index('delta_time')
+        t0, t1 = self.bounds
+        keep = []
+        for i in row_groups:
+            st = metadata.row_group(i).column(j).statistics
+            if st is None or not st.has_min_max or (st.max >= t0 and st.min < t1):
+                keep.append(i)
+        return keep
@@ -0,0 +1,193 @@
+import os
+import math
+import hashlib
+
+from cache import default_cache_dir
+from catalog import get_catalog
+
+#=================================================================
+# Visualization extra: interactive maps of the lookup table
+#=================================================================
+# Kept out of globalearthpoint so that the query and download code does
+# not load leafmap, folium and the notebook stack; globalearthpoint.mapview
+# imports this module on first use.
+#
+# mode='layers' draws every tile-year row of lookup.fgb as folium layers.
+# mode='overview' draws per-tile totals, precomputed once and cached on
+# disk, as coarse cells at low zoom and as the tiles in view (of the year
+# picked in the map) when zoomed in.
+
+# edge of the aggregated cells drawn below DETAIL_ZOOM, in degrees
+OVERVIEW_CELL = 20
+DETAIL_ZOOM = 4
+
+# ColorBrewer YlGn
+COLORS = ['#ffffe5', '#f7fcb9', '#d9f0a3', '#addd8e', '#78c679', '#41ab5d', '#238443', '#006837', '#004529']
+
+
+def tile_summary(lookup_file='lookup.fgb', cache_dir=None):
+    """
+    Point counts per tile of lookup.fgb: lon, lat (south-west corner), size,
+    n_points over all years and n_<year> per year, as a pandas DataFrame.
+
+    Computed once and cached as parquet in the cache directory, rebuilt
+    when lookup.fgb changes.
+    """
+    import pandas as pd
+    st = os.stat(lookup_file)
+    key = hashlib.sha1(f'{os.path.abspath(lookup_file)}:{st.st_size}:{st.st_mtime_ns}'.encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir or default_cache_dir(), 'mapview', f'tiles-{key}.parquet')
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+
+    table = get_catalog(lookup_file).table
+    xmin, _, xmax, _ = table.geometry.iloc[0].bounds
+    frame = pd.DataFrame({'lon': table['lon'].astype(int), 'lat': table['lat'].astype(int),
+                          'year': table['year'].astype(int), 'n_points': table['n_points'].astype('int64')})
+    summary = frame.pivot_table(index=['lon', 'lat'], columns='year', values='n_points', aggfunc='sum', fill_value=0)
+    summary.columns = [f'n_{year}' for year in summary.columns]
+    summary.insert(0, 'n_points', summary.sum(axis=1))
+    summary = summary.reset_index()
+    summary.insert(2, 'size', int(round(xmax - xmin)))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    summary.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    return summary
+
+
+def _coarse(summary, cell=OVERVIEW_CELL):
+    # tiles summed into cell x cell degree blocks
+    counts = [c for c in summary.columns if c.startswith('n_')]
+    frame = summary.assign(lon=summary['lon'] // cell * cell, lat=summary['lat'] // cell * cell)
+    frame = frame.groupby(['lon', 'lat'], as_index=False)[counts].sum()
+    frame['size'] = cell
+    return frame
+
+
+def _color(n, vmax):
+    # log scale, so sparse high-latitude tiles stay visible next to the tropics
+    level = math.log1p(n) / math.log1p(vmax) if vmax > 0 else 0
+    return COLORS[min(int(level * len(COLORS)), len(COLORS) - 1)]
+
+
+def _features(frame, column, vmax):
+    features = []
+    for lon, lat, size, n in zip(frame['lon'], frame['lat'], frame['size'], frame[column]):
+        if n <= 0:
+            continue
+        lon, lat, size = int(lon), int(lat), int(size)
+        ring = [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]
+        features.append({'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+                         'properties': {'lon': lon, 'lat': lat, 'size': size, 'n_points': int(n),
+                                        'style': {'fillColor': _color(n, vmax), 'color': '#555555',
+                                                  'weight': 0.5, 'fillOpacity': 0.7}}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def overview_map(lookup_file='lookup.fgb', cache_dir=None, center=(0, 0), zoom=2):
+    """
+    Light ipyleaflet map of the point counts of lookup.fgb.
+
+    Below DETAIL_ZOOM it shows OVERVIEW_CELL degree cells summed over the
+    tiles; zoomed in it shows the tiles inside the viewport only. The year
+    picked in the map switches the counts shown, loading only what is in view.
+    """
+    import ipyleaflet
+    import ipywidgets
+
+    tiles = tile_summary(lookup_file, cache_dir)
+    cells = _coarse(tiles)
+    years = sorted(int(c[2:]) for c in tiles.columns if c.startswith('n_') and c != 'n_points')
+
+    m = ipyleaflet.Map(center=center, zoom=zoom, basemap=ipyleaflet.basemaps.Esri.WorldImagery,
+                       scroll_wheel_zoom=True)
+    layer = ipyleaflet.GeoJSON(data={'type': 'FeatureCollection', 'features': []}, name='GEDI points',
+                               hover_style={'weight': 2, 'color': '#000000'})
+    year = ipywidgets.Dropdown(options=['all'] + years, value='all', description='Year',
+                               layout=ipywidgets.Layout(width='160px'))
+    info = ipywidgets.HTML('Number of points')
+    m.add(layer)
+    m.add(ipyleaflet.WidgetControl(widget=ipywidgets.VBox([year, info]), position='topright'))
+    shown = {'key': None}
+
+    def refresh(change=None):
+        column = 'n_points' if year.value == 'all' else f'n_{year.value}'
+        if m.zoom < DETAIL_ZOOM:
+            frame, key = cells, ('cells', column)
+            vmax = cells[column].max()
+        else:
+            vmax = tiles[column].max()
+            frame = tiles
+            if m.bounds:
+                (south, west), (north, east) = m.bounds
+                size = tiles['size']
+                frame = tiles[(tiles['lon'] + size >= west) & (tiles['lon'] <= east) &
+                               (tiles['lat'] + size >= south) & (tiles['lat'] <= north)]
+            key = ('tiles', column, tuple(frame.index))
+        # panning inside the same set of tiles does not redraw
+        if key != shown['key']:
+            shown['key'] = key
+            layer.data = _features(frame, column, vmax)
+
+    def hover(feature, **kwargs):
+        p = feature['properties']
+        info.value = (f"{p['lon']}..{p['lon'] + p['size']} E, {p['lat']}..{p['lat'] + p['size']} N: "
+                      f"<b>{p['n_points'] / 1e6:.2f}</b> million points")
+
+    refresh()
+    m.observe(refresh, names=['zoom', 'bounds'])
+    year.observe(refresh, names='value')
+    layer.on_hover(hover)
+    return m
+
+
+def _lookup_path(lookup_file, lookup_url=None):
+    # local lookup.fgb, written from `lookup_url` on first use if it is missing
+    lookup = os.path.join(os.getcwd(), lookup_file)
+    if not os.path.exists(lookup):
+        if lookup_url is None:
+            raise FileNotFoundError(f'{lookup} does not exist, pass lookup_url to fetch it')
+        import geopandas as gpd
+        lookup_table = gpd.read_file(lookup_url)
+        lookup_table['url'] = 'http://s3.eu-central-1.wasabisys.com/gedi-ard/level2/l2v002.gedi_20190418_20230316_go_epsg.4326_v20240614' + lookup_table['dir']
+        lookup_table.to_file(lookup, driver='FlatGeobuf')
+    return lookup
+
+
+def mapview(lookup_file='lookup.fgb', mode='layers', cache_dir=None, lookup_url=None):
+    #=================================================================
+    # Interactive map serving as an overview for Global Point Data
+    #=================================================================
+    # mode='overview' for the light, cached map, see overview_map()
+    if mode not in ('layers', 'overview'):
+        raise ValueError(f"Unsupported mode '{mode}', use 'layers' or 'overview'")
+    lookup = _lookup_path(lookup_file, lookup_url)
+    if mode == 'overview':
+        return overview_map(lookup, cache_dir)
+    import leafmap.foliumap as leafmap
+
+    # the table of the shared catalog, copied as the layers add columns
+    lookup_table = get_catalog(lookup).table.copy()
+
+    # Configure map options
+    basemaps = {
+        'Esri.WorldImagery': 'Esri.WorldImagery'
+    }
+
+    # Process the lookup table
+    lookup_table['n_points_mio'] = lookup_table['n_points'] / 1e06
+    ltm = {'N pts [mio]': lookup_table.iloc[1:2]}
+    ltm.update({year: group for year, group in lookup_table.groupby('year')})
+
+    # Create the base map
+    m = leafmap.Map(center=[0, 0], zoom=2)
+    for name, basemap in basemaps.items():
+        m.add_basemap(basemap)
+
+    # Add the layers to the map with customized colors
+    for year, data in ltm.items():
+        m.add_data(data, layer_name=f"Year {year}", column='n_points_mio', cmap='YlGn', legend_title='Number of Points (million)')
+
+    return m